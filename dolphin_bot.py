@@ -1,6 +1,13 @@
 import logging
 
 import op_dolphin_bot.dolphin_bot as dolphin
+import op_dolphin_bot.api as api
+import op_dolphin_bot.checkpoint as checkpoint
+import op_dolphin_bot.discovery as discovery
+import op_dolphin_bot.metrics as metrics
+import op_dolphin_bot.replay as replay
+import op_dolphin_bot.webhook as webhook
+from op_dolphin_bot.transport import HTTPTransport
 from op_dolphin_bot.constants import PROGRAM_NAME, PROGRAM_VERSION
 
 # CONFIGURATION START
@@ -11,14 +18,36 @@ SLACK_INCOMING_HOOK_URL = "https://hooks.slack.com/services/..."
 # Your base URL:
 OP_BASE_URL = "https://YOUR.OPENPROJECT..."
 
-# The ID of the project which activities are tracked. Use util/op_project_list.py if you aren't sure:
+# The ID of the project which activities are tracked. Use util/op_project_list.py if you aren't sure.
+# With OP_API_KEY, the identifier of the project (e.g. "my-project") can be used instead:
 OP_PROJECT_ID = 2
 
 # Your RSS API Key. See "Account Settings -> Tokens" in OpenProject.
 OP_RSS_KEY = "****************************************"
 
+# Optional API key (see "My account -> Access tokens"). Used to resolve OP_PROJECT_ID and to recover activities
+# that fell out of the Atom feed:
+OP_API_KEY = None
+
 # Specify elements you want to track. Recognizes everything except "cost_objects" and "time_entries" by default:
 OP_RSS_FILTER = ('work_packages', 'wiki_edits', 'news', 'documents', 'meetings')
+
+# Port for the Prometheus metrics (http://localhost:PORT/metrics) or None to disable.
+# With METRICS_PROFILING, the sampling profiler can be toggled via /debug/profile?action=start (and stop):
+METRICS_PORT = None
+METRICS_PROFILING = False
+
+# Port for OpenProject's outgoing webhooks (Administration -> Webhooks, URL http://HOST:PORT/op-webhook) or None.
+# With webhooks, work packages and time entries are posted right away, the feed is only polled for the other types:
+WEBHOOK_PORT = None
+WEBHOOK_SECRET = None
+
+# File that keeps the delivery state across restarts (changes while the bot was down are notified) or None:
+CHECKPOINT_FILE = "dolphin_checkpoint.sqlite"
+
+# File that records the feed responses and the Slack messages (e.g. "dolphin_recording.jsonl.gz") or None.
+# A recording can be replayed without network to reproduce and compare the messages: python -m util.replay FILE
+RECORD_FILE = None
 # ---
 # CONFIGURATION END
 
@@ -26,6 +55,26 @@ OP_RSS_FILTER = ('work_packages', 'wiki_edits', 'news', 'documents', 'meetings')
 logging.basicConfig(format='%(asctime)s - %(levelname)s: %(message)s', level=logging.DEBUG)
 logging.info("Started %s. Current version: %s", PROGRAM_NAME, PROGRAM_VERSION)
 
+if METRICS_PORT is not None:
+    metrics.MetricsServer(METRICS_PORT, enable_profiling=METRICS_PROFILING).start()
+
+receiver = None
+if WEBHOOK_PORT is not None:
+    # With an API key, pushed updates are credited to the user who made them (not the creator of the work package):
+    op_api = api.OpenProjectAPI(OP_BASE_URL, OP_API_KEY) if OP_API_KEY is not None else None
+    receiver = webhook.OpenProjectWebhookReceiver(OP_BASE_URL, WEBHOOK_SECRET, WEBHOOK_PORT, api=op_api).start()
+
+state = checkpoint.Checkpoint(CHECKPOINT_FILE) if CHECKPOINT_FILE is not None else None
+
+projects = None
+if OP_API_KEY is not None:
+    projects = discovery.ProjectDiscovery.create(OP_BASE_URL, OP_API_KEY, cache_path="dolphin_projects.json")
+
+transport = None
+if RECORD_FILE is not None:
+    transport = replay.RecordingTransport(replay.Recorder(RECORD_FILE), HTTPTransport())
+
 bot = dolphin.DolphinBot(SLACK_INCOMING_HOOK_URL, OP_BASE_URL, OP_PROJECT_ID, OP_RSS_KEY, OP_RSS_FILTER,
-                         refresh_rate=150, max_links=15, smart_summary_limit=2)
+                         refresh_rate=150, max_links=15, smart_summary_limit=2, webhook_receiver=receiver,
+                         checkpoint=state, op_api_key=OP_API_KEY, discovery=projects, transport=transport)
 bot.run()
@@ -0,0 +1,95 @@
+import re
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+# Work package activities link to the journal, e.g. ".../work_packages/21#activity-3" (or ".../21/activity#...."):
+_WORK_PACKAGE_ACTIVITY = re.compile(r'/work_packages/(\d+)(?:/activity)?#activity-(\d+)$')
+
+
+class Activity:
+    """ One OpenProject activity (e.g. an entry of the Atom feed), as passed from the feed reader to Slack """
+
+    __slots__ = ('title', 'url', 'datetime', 'author', 'type')
+
+    def __init__(self, title, url, datetime, author, type):
+        self.title = title
+        self.url = url
+        self.datetime = datetime
+        self.author = author
+        self.type = type
+
+    def __eq__(self, other):
+        if not isinstance(other, Activity):
+            return NotImplemented
+        return (self.title, self.url, self.datetime, self.author, self.type) == \
+               (other.title, other.url, other.datetime, other.author, other.type)
+
+    def __hash__(self):
+        return hash((self.url, self.datetime))
+
+    def change_key(self):
+        """ Identifies the change, independent of where the entry comes from (Atom feed, API backfill, ...).
+
+        Work package activities are identified by the work package ID and the journal version, because the
+        titles (and base URLs) differ between the sources. Other activities by their URL and time.
+        """
+        match = _WORK_PACKAGE_ACTIVITY.search(self.url or '')
+        if match is not None:
+            return int(match.group(1)), int(match.group(2))
+        return self.url, self.datetime
+
+    def __repr__(self):
+        return "Activity(title={0!r}, url={1!r}, datetime={2!r}, author={3!r}, type={4!r})" \
+            .format(self.title, self.url, self.datetime, self.author, self.type)
+
+
+_EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+# The offset of the local time zone can only change at DST transitions, which happen at quarters of an hour (UTC):
+_TZ_BUCKET_SECONDS = 15 * 60
+
+
+def parse_rfc3339(text, to_local_tz=True):
+    """ Parses RFC 3339 timestamps as used by OpenProject without strptime.
+
+    The common "2017-03-01T12:34:56Z" format is parsed by slicing. Fractional seconds and numeric offsets
+    (e.g. "2017-03-01T12:34:56.789+01:00" from the API) are supported, too.
+
+    :param text: RFC 3339 timestamp
+    :param to_local_tz: Converts the result to the local time zone, otherwise it is in UTC
+    :return: Time zone aware datetime
+    """
+    try:
+        year, month, day = int(text[0:4]), int(text[5:7]), int(text[8:10])
+        hour, minute, second = int(text[11:13]), int(text[14:16]), int(text[17:19])
+        if text[4] != '-' or text[7] != '-' or text[10] not in 'Tt ' or text[13] != ':' or text[16] != ':':
+            raise ValueError
+        rest = text[19:]
+        microsecond = 0
+        if rest.startswith('.'):
+            digits = 1
+            while digits < len(rest) and rest[digits].isdigit():
+                digits += 1
+            microsecond = int(rest[1:digits][:6].ljust(6, '0'))
+            rest = rest[digits:]
+        if rest in ('Z', 'z'):
+            offset = 0
+        elif len(rest) == 6 and rest[0] in '+-' and rest[3] == ':':
+            offset = (int(rest[1:3]) * 60 + int(rest[4:6])) * (1 if rest[0] == '+' else -1)
+        else:
+            raise ValueError
+    except (ValueError, IndexError):
+        raise ValueError("Invalid RFC 3339 timestamp: {0!r}".format(text))
+
+    dt = datetime(year, month, day, hour, minute, second, microsecond, timezone.utc)
+    if offset:
+        dt -= timedelta(minutes=offset)
+    if to_local_tz:
+        seconds = (dt.toordinal() - _EPOCH_ORDINAL) * 86400 + dt.hour * 3600 + dt.minute * 60 + dt.second
+        return dt.astimezone(_local_timezone(seconds // _TZ_BUCKET_SECONDS))
+    return dt
+
+
+@lru_cache(maxsize=1024)
+def _local_timezone(bucket):
+    """ Fixed-offset local time zone that is valid for the given quarter of an hour (see parse_rfc3339) """
+    return datetime.fromtimestamp(bucket * _TZ_BUCKET_SECONDS, timezone.utc).astimezone(tz=None).tzinfo
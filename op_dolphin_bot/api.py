@@ -0,0 +1,133 @@
+import base64
+import json
+import logging
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone
+from urllib.parse import urlencode
+
+from . import metrics
+from .activity import Activity, parse_rfc3339
+
+_API_SECONDS = metrics.REGISTRY.histogram('dolphin_api_request_seconds', "Duration of OpenProject API v3 requests")
+_BACKFILLED_ENTRIES = metrics.REGISTRY.counter('dolphin_backfilled_entries_total',
+                                               "Entries recovered via the API after a gap in the Atom feed")
+
+
+class OpenProjectAPI:
+    """ Minimal client for the OpenProject API v3 (HAL+JSON) that pages through collections concurrently """
+
+    def __init__(self, base_url, api_key=None, transport=None, concurrency=4, page_size=100, timeout=30):
+        """
+        Creates an OpenProjectAPI client.
+
+        :param base_url: Base URL for OpenProject
+        :param api_key: API key (see "My account -> Access tokens"), None for anonymous access
+        :param transport: Optional (shared) transport.HTTPTransport, urllib.request.urlopen is used otherwise
+        :param concurrency: Maximum number of requests in flight when paging or fetching several resources
+        :param page_size: Elements per page of a collection (OpenProject limits it, usually to 100-1000)
+        :param timeout: Timeout of a single request in seconds
+        """
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.timeout = timeout
+        self._urlopen = transport.urlopen if transport is not None else urllib.request.urlopen
+        self._headers = {'Accept': 'application/hal+json'}
+        if api_key is not None:
+            credentials = base64.b64encode("apikey:{0}".format(api_key).encode('utf8')).decode('ascii')
+            self._headers['Authorization'] = "Basic " + credentials
+
+    def get(self, path, params=None):
+        """ Returns the decoded JSON of a resource, e.g. get('/api/v3/projects/2'). Raises URLError/HTTPError. """
+        url = self.base_url + path
+        if params:
+            url += '?' + urlencode(params)
+        with _API_SECONDS.time():
+            with self._urlopen(urllib.request.Request(url, headers=self._headers), timeout=self.timeout) as response:
+                return json.loads(response.read().decode('utf8'))
+
+    def get_collection(self, path, params=None):
+        """ Returns all elements of a paginated collection. The pages after the first one are requested concurrently.
+        """
+        params = dict(params or {}, pageSize=self.page_size, offset=1)
+        first = self.get(path, params)
+        elements = list(first['_embedded']['elements'])
+        page_size = first.get('pageSize') or self.page_size
+        pages = range(2, -(-first.get('total', len(elements)) // page_size) + 1)
+        for page in self.map(lambda offset: self.get(path, dict(params, offset=offset)), pages):
+            elements.extend(page['_embedded']['elements'])
+        return elements
+
+    def map(self, func, items):
+        """ Like map(), but runs func for at most `concurrency` items at once (keeping the order of the results) """
+        items = list(items)
+        if len(items) <= 1 or self.concurrency <= 1:
+            return [func(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(items))) as executor:
+            return list(executor.map(func, items))
+
+
+class ActivityBackfill:
+    """ Recovers the work package activities that fell out of the Atom feed, via the API v3
+
+    The Atom feed only contains the newest entries. If more activities happen between two fetches, the older ones
+    are only available through the API: the work packages updated since the gap started, and their activities.
+    Other types (wiki, news, ...) have no activities in the API and cannot be recovered.
+    """
+
+    def __init__(self, api, project_id):
+        """
+        :param api: OpenProjectAPI client (with an API key that may read the project)
+        :param project_id: Numeric ID or identifier of the project
+        """
+        self._api = api
+        self._project_id = project_id
+
+    def fetch(self, since, until):
+        """
+        Returns the work package activities with since <= datetime <= until, newest first and without duplicates.
+        Both bounds are inclusive because the Atom feed has a resolution of seconds: other changes of the same second
+        may be missing, so the caller removes the ones it already has (see Activity.change_key).
+        Raises URLError/HTTPError (and ValueError for invalid responses).
+        """
+        filters = [{'updatedAt': {'operator': '<>d', 'values': [_format_utc(since), '']}}]
+        work_packages = self._api.get_collection(
+            '/api/v3/projects/{0}/work_packages'.format(self._project_id),
+            {'filters': json.dumps(filters), 'sortBy': json.dumps([['updatedAt', 'desc']])})
+        logging.debug("Backfill: %i work packages were updated since %s.", len(work_packages), since)
+        pages = self._api.map(
+            lambda wp: self._api.get('/api/v3/work_packages/{0}/activities'.format(wp['id'])), work_packages)
+
+        entries = {}
+        for work_package, page in zip(work_packages, pages):
+            title = work_package_title(work_package)
+            for activity in page['_embedded']['elements']:
+                created = parse_rfc3339(activity['createdAt'])
+                if since <= created <= until:
+                    url = "{0}/work_packages/{1}#activity-{2}".format(self._api.base_url, work_package['id'],
+                                                                     activity.get('version', activity['id']))
+                    entry = Activity(title, url, created, link_title(activity['_links'], 'user', None),
+                                     'work_packages')
+                    entries[entry.change_key()] = entry
+        _BACKFILLED_ENTRIES.inc(len(entries))
+        return sorted(entries.values(), key=lambda e: e.datetime, reverse=True)
+
+
+def link_title(links, name, default):
+    """ Title of a HAL link, e.g. the name of the author in a work package's _links """
+    link = links.get(name)
+    if link and link.get('title'):
+        return link['title']
+    return default
+
+
+def work_package_title(work_package):
+    """ Title in the style of the Atom feed, e.g. "Task #21 (In progress): Subject" """
+    links = work_package['_links']
+    return "{0} #{1} ({2}): {3}".format(link_title(links, 'type', "Work package"), work_package['id'],
+                                        link_title(links, 'status', "-"), work_package['subject'])
+
+
+def _format_utc(dt):
+    return dt.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
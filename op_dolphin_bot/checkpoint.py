@@ -0,0 +1,91 @@
+import atexit
+import json
+import logging
+import sqlite3
+import threading
+import time
+from datetime import timezone
+
+from .activity import parse_rfc3339
+
+
+class Checkpoint:
+    """ Small SQLite file that keeps the delivery state of the bots across restarts
+
+    Every bot stores one JSON document under its key (see DolphinBot): the delivery cursor of the feed, the index of
+    the repetition check and the summary of the held back entries. save() only updates the state in memory,
+    the changed states are written together in one transaction at most every `flush_interval` seconds (and at exit).
+    A transaction is atomic, a crash leaves the previous state, never a half-written one.
+    """
+
+    def __init__(self, path, flush_interval=5.0):
+        """
+        Opens (or creates) a Checkpoint.
+
+        :param path: Path of the SQLite file
+        :param flush_interval: Writes changed states at most every N seconds. A crash loses at most the changes of
+                               that time, which then are notified again (or skipped in case of the held back entries).
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS checkpoints "
+                         "(key TEXT PRIMARY KEY, state TEXT NOT NULL, updated REAL NOT NULL)")
+        self._db.commit()
+        self._dirty = {}
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self.stats = {'saves': 0, 'flushes': 0}
+        atexit.register(self.flush)
+
+    def load(self, key):
+        """ Returns the last saved state of the key, None if there is none """
+        with self._lock:
+            if key in self._dirty:
+                return json.loads(self._dirty[key])
+            row = self._db.execute("SELECT state FROM checkpoints WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def save(self, key, state):
+        """ Remembers the state (JSON serializable) of the key. It is written with the next (batched) flush. """
+        with self._lock:
+            self._dirty[key] = json.dumps(state, separators=(',', ':'))
+            self.stats['saves'] += 1
+            if time.monotonic() - self._last_flush < self.flush_interval:
+                return
+        self.flush()
+
+    def flush(self):
+        """ Writes all changed states in one transaction """
+        with self._lock:
+            self._last_flush = time.monotonic()
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            now = time.time()
+            try:
+                with self._db:
+                    self._db.executemany("INSERT OR REPLACE INTO checkpoints (key, state, updated) VALUES (?, ?, ?)",
+                                         [(key, state, now) for key, state in dirty.items()])
+                self.stats['flushes'] += 1
+            except sqlite3.Error as err:
+                # Keep the states for the next attempt:
+                self._dirty = dirty
+                logging.error("Unable to write the checkpoint %s. More info: %s", self.path, err)
+
+    def close(self):
+        self.flush()
+        atexit.unregister(self.flush)
+        self._db.close()
+
+
+def encode_time(dt):
+    if dt is None:
+        return None
+    return dt.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def decode_time(text):
+    return parse_rfc3339(text) if text is not None else None
@@ -0,0 +1,132 @@
+import json
+import logging
+import os
+import time
+import urllib.request
+
+from .api import OpenProjectAPI
+
+
+class ProjectDiscovery:
+    """ Finds the projects of an OpenProject instance and resolves project identifiers to IDs
+
+    The paginated /api/v3/projects collection is used if the instance has it. Older instances only have the
+    single resources (/api/v3/projects/{id}), so the IDs are scanned concurrently until a run of consecutive IDs
+    does not exist. The result is cached on disk, so a bot resolves its project without any request at startup.
+    """
+
+    def __init__(self, api, cache_path=None, ttl=24 * 3600, max_misses=20):
+        """
+        Creates a ProjectDiscovery.
+
+        :param api: OpenProjectAPI client (its API key determines which projects are visible)
+        :param cache_path: Optional JSON file that caches the discovered projects
+        :param ttl: Seconds the cached projects are used before they are discovered again
+        :param max_misses: The ID scan stops after N consecutive IDs without a (visible) project
+        """
+        self._api = api
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.max_misses = max_misses
+        self._projects = None
+        # Whether _projects was loaded from the cache (which may miss newer projects) instead of being discovered:
+        self._from_cache = False
+
+    @classmethod
+    def create(cls, op_base_url, api_key, transport=None, concurrency=8, **kwargs):
+        """ Creates a ProjectDiscovery with its own OpenProjectAPI client (see __init__ for the other parameters) """
+        return cls(OpenProjectAPI(op_base_url, api_key, transport, concurrency=concurrency), **kwargs)
+
+    def projects(self, refresh=False):
+        """ Returns the projects as list of dicts with 'id', 'identifier' and 'name' (sorted by ID) """
+        if not refresh:
+            if self._projects is None:
+                self._projects = self._load_cache()
+                self._from_cache = self._projects is not None
+            if self._projects is not None:
+                return self._projects
+        try:
+            projects = self._list_collection()
+        except urllib.request.HTTPError as http_err:
+            if http_err.code not in (400, 404, 405, 501):
+                raise
+            logging.info("The project collection is not available (Status: %i), scanning the project IDs instead.",
+                         http_err.code)
+            projects = self._scan_ids()
+        self._projects = sorted(projects, key=lambda p: p['id'])
+        self._from_cache = False
+        self._save_cache(self._projects)
+        return self._projects
+
+    def resolve(self, project):
+        """ Returns the numeric ID of a project given by its ID or identifier. Raises KeyError for unknown projects. """
+        if isinstance(project, int) or str(project).isdigit():
+            return int(project)
+        projects = self.projects()
+        if self._from_cache and not any(p['identifier'] == project for p in projects):
+            # Discover again if the identifier is unknown, the project may be newer than the cache:
+            projects = self.projects(refresh=True)
+        for p in projects:
+            if p['identifier'] == project:
+                return p['id']
+        raise KeyError("Unknown OpenProject project: {0}".format(project))
+
+    def _list_collection(self):
+        return [_project_info(p) for p in self._api.get_collection('/api/v3/projects')]
+
+    def _scan_ids(self):
+        projects = []
+        misses = 0
+        next_id = 1
+        batch_size = max(1, self._api.concurrency)
+        while misses < self.max_misses:
+            ids = range(next_id, next_id + batch_size)
+            next_id += batch_size
+            for project in self._api.map(self._get_project, ids):
+                if project is None:
+                    misses += 1
+                    if misses >= self.max_misses:
+                        break
+                else:
+                    misses = 0
+                    projects.append(project)
+        logging.debug("Scanned project IDs 1 to %i, found %i projects.", next_id - 1, len(projects))
+        return projects
+
+    def _get_project(self, project_id):
+        try:
+            return _project_info(self._api.get('/api/v3/projects/{0}'.format(project_id)))
+        except urllib.request.HTTPError as http_err:
+            # 404: there is no such project, 403: it is not visible with the API key. Both count as misses.
+            if http_err.code in (403, 404):
+                return None
+            raise
+
+    def _load_cache(self):
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return None
+        try:
+            with open(self.cache_path, encoding='utf8') as cache_file:
+                cache = json.load(cache_file)
+        except (OSError, ValueError) as err:
+            logging.warning("Ignoring the unreadable project cache %s. More info: %s", self.cache_path, err)
+            return None
+        if cache.get('base_url') != self._api.base_url or time.time() - cache.get('updated', 0) > self.ttl:
+            return None
+        return cache['projects']
+
+    def _save_cache(self, projects):
+        if self.cache_path is None:
+            return
+        # Write to a temporary file first, so a crash never leaves a half-written cache behind:
+        temp_path = self.cache_path + '.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf8') as cache_file:
+                json.dump({'base_url': self._api.base_url, 'updated': time.time(), 'projects': projects}, cache_file)
+            os.replace(temp_path, self.cache_path)
+        except OSError as err:
+            logging.warning("Unable to write the project cache %s. More info: %s", self.cache_path, err)
+
+
+def _project_info(project):
+    return {'id': project['id'], 'identifier': project['identifier'], 'name': project['name']}
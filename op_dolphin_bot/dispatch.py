@@ -0,0 +1,279 @@
+import asyncio
+import collections
+import http.client
+import logging
+import random
+import threading
+import time
+import urllib.request
+
+from . import metrics
+from .slack import SLACK_RETRIES
+
+
+class TokenBucket:
+    """ Thread-safe token bucket: allows bursts of up to `capacity` messages, refilled with `rate` tokens/second """
+
+    def __init__(self, rate=1.0, capacity=3):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Takes one token, sleeping until there is one. """
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def try_acquire(self):
+        """ Takes one token without blocking. Returns 0 on success, otherwise the seconds until there is one. """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def pause(self, seconds):
+        """ Empties the bucket for the given time, e.g. when Slack tells us to back off. """
+        with self._lock:
+            self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+
+# One bucket per webhook URL, so that several bots posting to the same channel share the limit:
+_BUCKETS = {}
+_BUCKETS_LOCK = threading.Lock()
+
+
+def get_webhook_bucket(url_hook, rate=1.0, capacity=3):
+    with _BUCKETS_LOCK:
+        bucket = _BUCKETS.get(url_hook)
+        if bucket is None:
+            bucket = _BUCKETS[url_hook] = TokenBucket(rate, capacity)
+        return bucket
+
+
+class SlackDispatcher:
+    """ Delivers Slack messages from a bounded queue in a background thread (or a coroutine, see drain), so that
+    posting never blocks polling
+
+    Slack's rate limit (HTTP 429 with Retry-After) is honored, other failures are retried with jittered exponential
+    backoff. If messages pile up (e.g. during an outage), the queued ones are merged into one summarized message.
+    """
+
+    def __init__(self, slack_connection, message_builder=None, max_queue=50, merge_threshold=5, max_retries=8,
+                 base_backoff=1.0, max_backoff=120.0, rate=1.0, burst=3, metrics_labels=None):
+        """
+        Creates a SlackDispatcher. Call start() to launch the delivery thread, or run drain() on an event loop.
+
+        :param slack_connection: SlackConnection used for sending
+        :param message_builder: SlackMessageBuilder used to merge queued messages. If None, nothing is merged.
+        :param max_queue: Maximum number of queued messages. If exceeded, the oldest message is dropped.
+        :param merge_threshold: Merges the queued messages into one summary as soon as N messages are waiting
+        :param max_retries: Gives up on a message after N failed attempts (None: retry forever)
+        :param base_backoff: Initial backoff in seconds, doubled after every failed attempt (plus jitter)
+        :param max_backoff: Upper limit for the backoff in seconds
+        :param rate: Messages per second allowed for the webhook (Slack allows about one per second)
+        :param burst: Number of messages that may be sent at once before the rate applies
+        :param metrics_labels: Labels of the queue depth metric, e.g. {'project': '2'}
+        """
+        self._slack = slack_connection
+        self._builder = message_builder
+        self._max_queue = max_queue
+        self._merge_threshold = merge_threshold
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._bucket = get_webhook_bucket(slack_connection.url_hook, rate, burst)
+
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+        self._in_flight = False
+        self._in_flight_entries = None
+        self._thread = None
+        # Wakes up drain() when a message is submitted:
+        self._wakeup = None
+        self.stats = {'submitted': 0, 'sent': 0, 'retries': 0, 'merged': 0, 'dropped': 0, 'failed': 0}
+        self._queue_depth = metrics.REGISTRY.gauge('dolphin_slack_queue_depth', "Messages waiting for delivery",
+                                                   metrics_labels)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._deliver_forever, name="SlackDispatcher", daemon=True)
+            self._thread.start()
+        return self
+
+    def submit(self, message, entries=None):
+        """
+        Enqueues a message without blocking.
+
+        :param message: JSON message as built by the SlackMessageBuilder
+        :param entries: The entries (list or summary.SummaryAggregator) the message was built from.
+                        Required for merging, messages without are kept as-is.
+        """
+        with self._condition:
+            self.stats['submitted'] += 1
+            self._queue.append((message, entries))
+            if len(self._queue) >= self._merge_threshold:
+                self._merge_queued()
+            while len(self._queue) > self._max_queue:
+                self._queue.popleft()
+                self.stats['dropped'] += 1
+                logging.warning("Slack delivery queue is full (%i), dropped the oldest message.", self._max_queue)
+            self._queue_depth.set(len(self._queue))
+            self._condition.notify()
+            if self._wakeup is not None:
+                self._wakeup()
+
+    def queue_depth(self):
+        return len(self._queue)
+
+    def undelivered(self):
+        """ Returns the entries of the messages that have not been delivered yet (queued or being sent), e.g. to save
+        them in a checkpoint. Messages submitted without entries are left out. """
+        with self._condition:
+            pending = [self._in_flight_entries] if self._in_flight_entries else []
+            pending.extend(entries for _, entries in self._queue if entries)
+            return pending
+
+    def flush(self, timeout=None):
+        """ Waits until all queued messages have been delivered (or given up). Returns False on timeout. """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._queue or self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def _merge_queued(self):
+        if self._builder is None:
+            return
+        mergeable = [item for item in self._queue if item[1]]
+        if len(mergeable) < 2:
+            return
+        # Entries are lists or summaries (SummaryAggregator) of held back entries:
+        summary = self._builder.create_summary()
+        for _, item_entries in mergeable:
+            summary.extend(item_entries)
+        kept = [item for item in self._queue if not item[1]]
+        self._queue.clear()
+        self._queue.extend(kept)
+        self._queue.append((self._builder.build_multi_part_message(summary), summary))
+        self.stats['merged'] += len(mergeable)
+        logging.info("Slack delivery is backing up, merged %i queued messages into one summary.", len(mergeable))
+
+    async def drain(self, run_blocking):
+        """
+        Delivers the queued messages forever, like the thread of start() but as a coroutine. Used by the
+        engine.DolphinEngine, so that the dispatchers of all projects share its event loop and executor.
+
+        :param run_blocking: Coroutine function that runs a blocking function with arguments and returns its result,
+                             e.g. in an executor. Only the requests are passed to it, the waits are asyncio.sleep.
+        """
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        self._wakeup = lambda: loop.call_soon_threadsafe(wakeup.set)
+        while True:
+            # Cleared before looking at the queue, so a message submitted in between sets it again:
+            wakeup.clear()
+            with self._condition:
+                message = self._take() if self._queue else None
+            if message is None:
+                await wakeup.wait()
+                continue
+            try:
+                attempt = 0
+                while True:
+                    wait = self._bucket.try_acquire()
+                    if not wait:
+                        attempt += 1
+                        wait = await run_blocking(self._attempt, message, attempt)
+                        if wait is None:
+                            break
+                    await asyncio.sleep(wait)
+            except Exception:
+                self._drop_failed()
+            finally:
+                self._done()
+
+    def _deliver_forever(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                message = self._take()
+            try:
+                self._deliver(message)
+            except Exception:
+                self._drop_failed()
+            finally:
+                self._done()
+
+    def _take(self):
+        # Caller holds the condition and made sure that the queue is not empty:
+        message, self._in_flight_entries = self._queue.popleft()
+        self._queue_depth.set(len(self._queue))
+        self._in_flight = True
+        return message
+
+    def _done(self):
+        with self._condition:
+            self._in_flight = False
+            self._in_flight_entries = None
+            self._condition.notify_all()
+
+    def _drop_failed(self):
+        # E.g. a message that cannot be encoded: the delivery must go on, otherwise flush() never returns
+        self.stats['failed'] += 1
+        logging.exception("Unable to deliver a Slack message, dropped it.")
+
+    def _deliver(self, message):
+        attempt = 0
+        while True:
+            self._bucket.acquire()
+            attempt += 1
+            wait = self._attempt(message, attempt)
+            if wait is None:
+                return
+            time.sleep(wait)
+
+    def _attempt(self, message, attempt):
+        """ Sends the message once. Returns the seconds to wait before the next attempt, or None if the message is
+        done (sent or given up). """
+        try:
+            self._slack.send(message)
+            self.stats['sent'] += 1
+            return None
+        except urllib.request.HTTPError as http_err:
+            logging.error("Error while executing HTTP request to Slack (Status: %i). "
+                          "More info: %s", http_err.code, http_err)
+            wait = self._slack.retry_after(http_err)
+            if wait is not None:
+                # Rate limited: All messages to this webhook have to wait, not just this one.
+                self._bucket.pause(wait)
+        except (OSError, http.client.HTTPException) as url_err:
+            logging.error("Unable to connect to Slack. Probably not connected to the internet or wrong URL."
+                          " More info: %s", url_err)
+            wait = None
+        if self.max_retries is not None and attempt > self.max_retries:
+            self.stats['failed'] += 1
+            logging.error("Giving up on a Slack message after %i retries.", self.max_retries)
+            return None
+        self.stats['retries'] += 1
+        SLACK_RETRIES.inc()
+        if wait is None:
+            # "Full jitter" exponential backoff:
+            wait = random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** (attempt - 1)))
+            logging.info("Retry #%i in %.1f seconds.", attempt, wait)
+            return wait
+        logging.info("Retry #%i after Slack's rate limit of %.1f seconds.", attempt, wait)
+        # The bucket is paused for that long (see TokenBucket.pause):
+        return 0
@@ -1,29 +1,75 @@
+import hashlib
 import logging
 import time
 
-from .open_project import OpenProjectURL, OpenProjectActivities
+from . import metrics
+from .api import OpenProjectAPI, ActivityBackfill
+from .checkpoint import encode_time, decode_time
+from .open_project import OpenProjectURL, OpenProjectActivities, ActivityClassifier
+from .dispatch import SlackDispatcher
+from .scheduler import AdaptivePollScheduler
 from .slack import SlackConnection, SlackMessageBuilder
+from .summary import DedupIndex, SummaryAggregator
+from .transport import HTTPTransport
+
+_LOOP_DRIFT_SECONDS = metrics.REGISTRY.histogram('dolphin_loop_drift_seconds',
+                                                 "Delay of a refresh compared to its scheduled deadline")
 
 
 class DolphinBot:
     DEFAULT_FILTERS = ('work_packages', 'wiki', 'news', 'documents', 'meetings', 'cost_objects', 'time_entries')
 
     def __init__(self, slack_hook_url, op_base_url, op_project_id, op_atom_key, activity_filters=DEFAULT_FILTERS,
-                 repetitions_allowed=False, refresh_rate=90, smart_summary_limit=2, max_links=7):
+                 repetitions_allowed=False, refresh_rate=90, smart_summary_limit=2, max_links=7, transport=None,
+                 activity_types=None, min_refresh_rate=None, max_refresh_rate=None, webhook_receiver=None,
+                 reconcile_rate=None, feed_hub=None, op_api_key=None, checkpoint=None, checkpoint_key=None,
+                 repetition_window=600, discovery=None, clock=time):
         """
         Creates a DolphinBot.
 
         :param slack_hook_url: URL of the incoming webhook for Slack
         :param op_base_url: Base URL for OpenProject
-        :param op_project_id: Numeric ID for the project which activities should be tracked
+        :param op_project_id: Numeric ID for the project which activities should be tracked. With `discovery`, the
+                              identifier of the project (e.g. "dolphin-bot") works, too.
         :param op_atom_key: RSS/Atom key (see Profile -> Tokens)
         :param refresh_rate: Checks the feed every N seconds. The lower, the newer the messages posted in Slack.
-                            This parameter also influences the smart summary feature (see below for an example)
-        :param repetitions_allowed: If true, two entries after each other with the same content will be posted
+                            This parameter also influences the smart summary feature (see below for an example).
+                            The actual interval adapts to the feed activity within min/max_refresh_rate.
+        :param min_refresh_rate: Shortest interval while the feed is busy (default: refresh_rate / 3)
+        :param max_refresh_rate: Longest interval while the feed is idle (default: refresh_rate * 4).
+                                 Set both to refresh_rate for a fixed interval.
+        :param repetitions_allowed: If true, entries with the same content (title, author and page) will be posted
+        :param repetition_window: Otherwise, such an entry is skipped if the same content was seen within N seconds
         :param smart_summary_limit: Automatically summarizes multiple new updates after N messages posted.
         :param max_links: Adds N links in the text field of the attachment when using the smart summary.
+        :param transport: HTTPTransport (connection pool) shared by the Slack and OpenProject requests.
+                          Pass the same instance to several bots to share the pool. Default: a new HTTPTransport.
+        :param activity_types: Additional URL path segments mapped to activity types, e.g. {'boards': 'forums'} for
+                               OpenProject instances with custom modules (see open_project.ActivityClassifier).
+        :param webhook_receiver: Optional webhook.OpenProjectWebhookReceiver (push mode). Pushed entries are processed
+                                 right away instead of waiting for the next refresh. Types the webhooks cover are
+                                 not requested from the Atom feed anymore, which is only polled every reconcile_rate
+                                 seconds for the remaining types (not at all if no type remains).
+        :param reconcile_rate: Polls the Atom feed every N seconds in push mode (default: refresh_rate * 10)
+        :param feed_hub: Optional hub.FeedHub shared by several bots watching the same project (e.g. with other
+                         filters for other channels). The feed is then fetched once for all of them.
+                         activity_types has to be configured on the hub in this case (a ValueError is raised
+                         otherwise, see FeedHub's classifier).
+        :param op_api_key: Optional API key (see "My account -> Access tokens"). If the feed is too short to reach
+                           back to the last delivered entry (e.g. many changes during a long refresh_rate), the
+                           missing work package activities are recovered via the API v3 (see api.ActivityBackfill),
+                           if the feed contains work packages.
+        :param checkpoint: Optional checkpoint.Checkpoint. The bot saves its delivery state after every refresh and
+                           resumes from it on startup: activities that happened while it was down are notified, held
+                           back entries and messages still waiting for Slack are not lost, and the initial (blocking)
+                           feed request is skipped.
+        :param checkpoint_key: Key of the bot in the checkpoint. The default is derived from the project and the Slack
+                               hook, so several bots can share one checkpoint.
+        :param discovery: Optional discovery.ProjectDiscovery that resolves a project identifier to its ID at startup
+        :param clock: Provides time(), monotonic() and sleep() for the scheduling, the repetition window and the age of
+                      summaries. Default: the time module. replay.VirtualClock replays a recording without waiting.
 
-        Example scenarios of the smart summary feature (parameters have default values):
+        Example scenarios of the smart summary feature (parameters have default values, without adaptation):
           (1) There is 1 new activity (entry) in 90 seconds
               -> post the change immediately using SINGLE_MESSAGE (see slack.SlackMessageBuilder)
           (2) There are 2 new activities in 90 seconds. They are held back another 90 seconds.
@@ -31,53 +77,169 @@ class DolphinBot:
                 * Else, post all held back changes by using a SUMMARIZED_MESSAGE (see slack.SlackMessageBuilder).
 
         """
+        if activity_types and feed_hub is not None:
+            raise ValueError("activity_types can not be used with a feed_hub, pass a classifier to the FeedHub instead")
+        if discovery is not None:
+            op_project_id = discovery.resolve(op_project_id)
         self._refresh = refresh_rate
+        self._clock = clock
+        self.scheduler = AdaptivePollScheduler(
+            refresh_rate,
+            min_interval=refresh_rate / 3 if min_refresh_rate is None else min_refresh_rate,
+            max_interval=refresh_rate * 4 if max_refresh_rate is None else max_refresh_rate,
+            clock=clock.monotonic)
         self.repetitions_allowed = repetitions_allowed
         self._smart_summary_limit = smart_summary_limit
         self._max_links = max_links
+        self._dedup = DedupIndex(window=repetition_window, clock=clock.monotonic)
+        self._checkpoint = checkpoint
+        self._checkpoint_key = checkpoint_key
+        if checkpoint is not None and checkpoint_key is None:
+            hook_hash = hashlib.sha1(slack_hook_url.encode('utf8')).hexdigest()[:12]
+            self._checkpoint_key = "{0}/projects/{1}#{2}".format(op_base_url, op_project_id, hook_hash)
+
+        self.transport = transport if transport is not None else HTTPTransport()
 
         op_url_builder = OpenProjectURL(op_base_url, op_project_id)
-        self._slack = SlackConnection(slack_hook_url)
-        self._builder = SlackMessageBuilder(op_url_builder, self._max_links)
-        self._op_activities = \
-            OpenProjectActivities(op_url_builder.build_activity_atom_url(op_atom_key, activity_filters))
+        self._slack = SlackConnection(slack_hook_url, transport=self.transport)
+        self._builder = SlackMessageBuilder(op_url_builder, self._max_links, clock=clock.time)
+        # Entries held back by the smart summary, aggregated as they arrive:
+        self._summary = self._builder.create_summary()
+        metrics_labels = {'project': str(op_project_id)}
+        self.dispatcher = SlackDispatcher(self._slack, self._builder, metrics_labels=metrics_labels)
+        self._held_back_gauge = metrics.REGISTRY.gauge('dolphin_held_back_entries',
+                                                       "Entries held back by the smart summary", metrics_labels)
+        cursor = self._load_checkpoint()
+
+        self._inbox = None
+        self._reconcile = None
+        self._next_reconcile = 0.0
+        if webhook_receiver is not None:
+            self._inbox = webhook_receiver.subscribe(op_project_id)
+            self._reconcile = refresh_rate * 10 if reconcile_rate is None else reconcile_rate
+            activity_filters = [f for f in activity_filters if f not in webhook_receiver.COVERED_FILTERS]
+        backfill = None
+        # The backfill recovers work package activities only. Without work packages in the feed (e.g. because the
+        # webhooks deliver them), it would notify activities the bot is not supposed to or already did notify:
+        if op_api_key is not None and 'work_packages' in activity_filters:
+            backfill = ActivityBackfill(OpenProjectAPI(op_base_url, op_api_key, self.transport), op_project_id)
+        self._op_activities = None
+        if activity_filters and feed_hub is not None:
+            self._op_activities = feed_hub.subscribe(op_url_builder, op_atom_key, activity_filters,
+                                                     max_age=self._reconcile or self.scheduler.min_interval,
+                                                     backfill=backfill, last_deliver_time=cursor)
+        elif activity_filters:
+            self._op_activities = \
+                OpenProjectActivities(op_url_builder.build_activity_atom_url(op_atom_key, activity_filters),
+                                      transport=self.transport,
+                                      classifier=ActivityClassifier(activity_types) if activity_types else None,
+                                      backfill=backfill, last_deliver_time=cursor)
+        if self._reconcile is not None:
+            self._next_reconcile = self._clock.monotonic() + self._reconcile
+
+    @property
+    def refresh_rate(self):
+        return self._refresh
+
+    @property
+    def inbox(self):
+        """ webhook.WebhookInbox of the pushed entries (None without webhook_receiver) """
+        return self._inbox
 
     def run(self):
-        logging.info("Watching for changes now in Atom activity feed...")
-        old_entry = None
-        held_back_entries = []
+        logging.info("Watching for changes now in %s...",
+                     "Atom activity feed" if self._inbox is None else "pushed webhooks")
+        self.dispatcher.start()
         while True:
             logging.debug("Refreshing now...")
-            newest_entries = self._op_activities.deliver_updates()
-            # if there are any new entries:
-            if newest_entries:
-                logging.info("Found a total of %i changes.", len(newest_entries))
-                for entry in newest_entries:
-                    # if repetitions are allowed or there are no repetitions:
-                    if self.repetitions_allowed or \
-                                    old_entry is None or (
-                            old_entry is not None and not self._are_entries_equal(old_entry, entry)):
-                        # if smart summary not active:
-                        if not held_back_entries and len(newest_entries) < self._smart_summary_limit:
-                            self._slack.post(self._builder.build_single_message(entry))
-                        else:
-                            held_back_entries.append(entry)
-                    old_entry = entry
-                if held_back_entries:
-                    logging.info("Smart summary Limit (%i) exceeded - holding back the new changes. "
-                                 "Waiting another %i seconds...",
-                                 self._smart_summary_limit, self._refresh)
-            # elif there are any elements held_back_entries by the smart summary feature:
-            elif held_back_entries:
-                logging.info("Feed remained silent the last %i seconds, so we will post the summarized version.",
-                             self._refresh)
-                self._slack.post(self._builder.build_multi_part_message(held_back_entries))
-                held_back_entries.clear()
-            time.sleep(self._refresh)
-
-    @staticmethod
-    def _are_entries_equal(e1, e2):
-        for test in ('title', 'author'):
-            if e1[test] != e2[test]:
-                return False
-        return True
+            _LOOP_DRIFT_SECONDS.observe(self.scheduler.lateness())
+            for message, entries in self.process_entries(self.fetch_updates()):
+                # Posting happens in the background, a slow or unavailable Slack does not delay the next refresh:
+                self.dispatcher.submit(message, entries)
+            # In push mode, arriving entries end the wait early (the deadline of the next refresh stays the same):
+            self.scheduler.wait(sleep=self._clock.sleep if self._inbox is None else self._inbox.wait)
+
+    def fetch_updates(self):
+        """ Returns the new entries: the pushed ones and, if due, the ones of the feed (fetching it blocks). """
+        entries = []
+        if self._op_activities is not None and self._clock.monotonic() >= self._next_reconcile:
+            entries = self._op_activities.deliver_updates()
+            if self._reconcile is not None:
+                self._next_reconcile = self._clock.monotonic() + self._reconcile
+        if self._inbox is not None:
+            entries.extend(self._inbox.drain())
+        return entries
+
+    def post(self, message):
+        """ Posts the given message to Slack (blocking). """
+        self._slack.post(message)
+
+    def process_entries(self, newest_entries):
+        """
+        Applies the repetition check and the smart summary to the newest entries of one refresh.
+
+        :param newest_entries: Entries returned by one call of fetch_updates
+        :return: List of (message, entries) tuples that are due for posting (in order)
+        """
+        messages = []
+        # if there are any new entries:
+        if newest_entries:
+            logging.info("Found a total of %i changes.", len(newest_entries))
+            for entry in newest_entries:
+                # if repetitions are allowed or there are no repetitions (within the repetition window).
+                # Pushed updates without the acting user (see webhook.PushedActivity) are changes of their own:
+                if self.repetitions_allowed or not getattr(entry, 'author_known', True) or \
+                        not self._dedup.seen(entry):
+                    # if smart summary not active:
+                    if not self._summary and len(newest_entries) < self._smart_summary_limit:
+                        messages.append((self._builder.build_single_message(entry), [entry]))
+                    else:
+                        self._summary.add(entry)
+        # elif there are any entries held back by the smart summary feature:
+        elif self._summary:
+            logging.info("Feed remained silent the last %.1f seconds, so we will post the summarized version.",
+                         self.scheduler.last_delay)
+            message = self._builder.build_multi_part_message(self._summary)
+            messages.append((message, self._summary))
+            self._summary = self._builder.create_summary()
+        # Entries that are held back wait for at least one more refresh_rate, however the interval adapts:
+        self.scheduler.record(len(newest_entries), holding_back=bool(self._summary))
+        if newest_entries and self._summary:
+            logging.info("Smart summary Limit (%i) exceeded - holding back the new changes. "
+                         "Waiting another %.1f seconds...",
+                         self._smart_summary_limit, self.scheduler.interval)
+        self._held_back_gauge.set(len(self._summary))
+        self._save_checkpoint(messages)
+        return messages
+
+    def _load_checkpoint(self):
+        """ Restores the state of the last run and returns the delivery cursor of the feed (None if unknown) """
+        state = self._checkpoint.load(self._checkpoint_key) if self._checkpoint is not None else None
+        if state is None:
+            return None
+        self._summary = SummaryAggregator.from_state(state['summary'], self._max_links)
+        self._dedup.restore(state.get('dedup', ()))
+        if state.get('undelivered'):
+            # Messages that were still waiting for Slack are posted again, as one summary:
+            undelivered = SummaryAggregator.from_state(state['undelivered'], self._max_links)
+            self.dispatcher.submit(self._builder.build_multi_part_message(undelivered), undelivered)
+            logging.info("Resuming from checkpoint: %i entries were not posted yet.", len(undelivered))
+        cursor = decode_time(state.get('cursor'))
+        logging.info("Resuming from checkpoint: delivered until %s, %i entries held back.",
+                     cursor, len(self._summary))
+        return cursor
+
+    def _save_checkpoint(self, messages):
+        if self._checkpoint is None:
+            return
+        cursor = self._op_activities.cursor if self._op_activities is not None else None
+        # The cursor already is past the entries of messages that are not in Slack yet, so they are saved as well:
+        undelivered = self._builder.create_summary()
+        for entries in self.dispatcher.undelivered() + [entries for _, entries in messages]:
+            undelivered.extend(entries)
+        self._checkpoint.save(self._checkpoint_key, {
+            'cursor': encode_time(cursor),
+            'summary': self._summary.to_state(),
+            'dedup': self._dedup.to_state(),
+            'undelivered': undelivered.to_state() if undelivered else None,
+        })
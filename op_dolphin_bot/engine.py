@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+from .dolphin_bot import DolphinBot
+from .hub import FeedHub
+from .open_project import ActivityClassifier
+from .transport import HTTPTransport
+
+
+class DolphinEngine:
+    """ Watches many projects in a single process by running every DolphinBot as a coroutine on one event loop """
+
+    def __init__(self, max_concurrent_requests=8, start_spread=None, transport=None, share_feeds=True,
+                 checkpoint=None, activity_types=None):
+        """
+        Creates a DolphinEngine.
+
+        :param max_concurrent_requests: Global limit of requests in flight (feeds and Slack posts), which is also the
+                                        number of threads doing the blocking I/O for all projects.
+        :param start_spread: Spreads the first poll of the projects over N seconds so they do not all fetch at once.
+                             Defaults to the refresh rate of the respective project.
+        :param transport: HTTPTransport shared by all projects (unless a project is added with its own transport).
+                          Default: a new HTTPTransport with one pooled connection per concurrent request and host.
+        :param share_feeds: Projects that are added several times (e.g. with other filters for other channels) share
+                            one feed request via `feed_hub` (see hub.FeedHub).
+        :param checkpoint: Optional checkpoint.Checkpoint shared by all projects (see DolphinBot)
+        :param activity_types: Additional URL path segments mapped to activity types for all projects (see DolphinBot).
+                               With shared feeds, add_project does not take activity_types, the hub classifies.
+        """
+        self._max_concurrent_requests = max_concurrent_requests
+        self._start_spread = start_spread
+        self._projects = []
+        self.transport = transport if transport is not None else HTTPTransport(pool_size=max_concurrent_requests)
+        self.activity_types = activity_types
+        self.feed_hub = None
+        if share_feeds:
+            self.feed_hub = FeedHub(self.transport, ActivityClassifier(activity_types) if activity_types else None)
+        self.checkpoint = checkpoint
+        self._semaphore = None
+        self._executor = None
+        self._loop = None
+
+    def add_project(self, *args, **kwargs):
+        """ Registers a project. Takes the same parameters as DolphinBot, which is created lazily in run(). """
+        kwargs.setdefault('transport', self.transport)
+        if self.feed_hub is not None:
+            kwargs.setdefault('feed_hub', self.feed_hub)
+        elif self.activity_types is not None:
+            kwargs.setdefault('activity_types', self.activity_types)
+        if kwargs.get('activity_types') and kwargs.get('feed_hub') is not None:
+            # Would only fail when the bot is created in run(), so fail right away:
+            raise ValueError("Shared feeds are classified by the engine, pass activity_types to DolphinEngine")
+        if self.checkpoint is not None:
+            kwargs.setdefault('checkpoint', self.checkpoint)
+        self._projects.append((args, kwargs))
+
+    def run(self):
+        """ Runs all registered projects until interrupted (blocking). """
+        self._loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(max_workers=self._max_concurrent_requests)
+        try:
+            self._loop.run_until_complete(self.run_async())
+        finally:
+            self._executor.shutdown(wait=False)
+            self._loop.close()
+
+    async def run_async(self):
+        self._semaphore = asyncio.Semaphore(self._max_concurrent_requests)
+        logging.info("Watching %i projects with at most %i concurrent requests...",
+                     len(self._projects), self._max_concurrent_requests)
+        # A project that fails to start (e.g. an unknown project identifier) must not stop the others:
+        results = await asyncio.gather(*[self._watch(args, kwargs) for args, kwargs in self._projects],
+                                       return_exceptions=True)
+        for (args, kwargs), result in zip(self._projects, results):
+            if isinstance(result, Exception):
+                project_id = args[2] if len(args) > 2 else kwargs.get('op_project_id')
+                logging.error("Stopped watching project %s. More info: %r", project_id, result)
+
+    async def _call(self, func, *args):
+        # Blocking I/O runs in the executor, but never more than max_concurrent_requests at once:
+        async with self._semaphore:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def _create_bot(self, args, kwargs):
+        while True:
+            try:
+                return await self._call(lambda: DolphinBot(*args, **kwargs))
+            except OSError as err:
+                retry = kwargs.get('refresh_rate', 90)
+                logging.error("Unable to start watching a project, retrying in %i seconds. More info: %s", retry, err)
+                await asyncio.sleep(retry)
+
+    async def _watch(self, args, kwargs):
+        spread = self._start_spread if self._start_spread is not None else kwargs.get('refresh_rate', 90)
+        await asyncio.sleep(random.uniform(0, spread))
+        bot = await self._create_bot(args, kwargs)
+        logging.info("Watching for changes now in Atom activity feed...")
+        # Posting happens in a coroutine of its own: a slow or unavailable Slack does not delay the polling, and it
+        # only holds a request slot while a post is in flight (not while backing off):
+        await asyncio.gather(self._poll(bot), bot.dispatcher.drain(self._call))
+
+    async def _poll(self, bot):
+        pushed = asyncio.Event()
+        if bot.inbox is not None:
+            loop = asyncio.get_running_loop()
+            bot.inbox.add_listener(lambda: loop.call_soon_threadsafe(pushed.set))
+        while True:
+            # Cleared before the inbox is drained, so entries that arrive while processing end the next wait:
+            pushed.clear()
+            # Same semantics as DolphinBot.run, just without blocking the other projects:
+            try:
+                newest_entries = await self._call(bot.fetch_updates)
+                for message, entries in bot.process_entries(newest_entries):
+                    bot.dispatcher.submit(message, entries)
+            except Exception:
+                # One misbehaving project (e.g. a malformed feed) must not take down all the others:
+                logging.exception("Unexpected error while watching a project.")
+            await self._wait(bot, pushed)
+
+    @staticmethod
+    async def _wait(bot, pushed):
+        # Like DolphinBot.run: pushed entries end the wait early, the deadline of the next refresh stays the same
+        try:
+            await asyncio.wait_for(pushed.wait(), bot.scheduler.next_delay())
+        except asyncio.TimeoutError:
+            return
+        if bot.inbox.settle:
+            await asyncio.sleep(bot.inbox.settle)
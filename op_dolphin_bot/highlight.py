@@ -0,0 +1,57 @@
+import re
+from functools import lru_cache
+
+ITALIC = '_'
+BOLD = '*'
+
+
+class KeywordHighlighter:
+    """ Highlights keywords in Slack's markup by rewriting the text in one pass
+
+    All rules are compiled into a single alternation, so the cost does not grow with the number of keywords.
+    Matches have to be whole words, e.g. "New" does not match inside "Renewal". Longer keywords win over shorter ones
+    ("In progress" before "In"). Results are memoized, because the same titles come up again and again.
+    """
+
+    def __init__(self, italic_keywords=(), bold_keywords=(), patterns=(), cache_size=4096):
+        """
+        Creates a KeywordHighlighter.
+
+        :param italic_keywords: Plain keywords (no regular expressions) printed in italic
+        :param bold_keywords: Plain keywords (no regular expressions) printed in bold
+        :param patterns: Additional rules as (regular expression, markup) tuples, e.g. (r'#[0-9]+', BOLD) to print
+                         ticket references like '#12' in bold. Must not contain named groups.
+        :param cache_size: Number of memoized results
+        """
+        # One group per markup: [markup, [patterns...]] (a list keeps the order of the rules)
+        rules = [[ITALIC, [re.escape(kw) for kw in sorted(italic_keywords, key=len, reverse=True)]],
+                 [BOLD, [re.escape(kw) for kw in sorted(bold_keywords, key=len, reverse=True)]]]
+        for pattern, markup in patterns:
+            for rule in rules:
+                if rule[0] == markup:
+                    rule[1].append(pattern)
+                    break
+            else:
+                rules.append([markup, [pattern]])
+
+        self._markups = {}
+        alternatives = []
+        for markup, rule_patterns in rules:
+            if rule_patterns:
+                group = 'm{0}'.format(len(alternatives))
+                self._markups[group] = markup
+                alternatives.append('(?P<{0}>{1})'.format(group, '|'.join(rule_patterns)))
+        if alternatives:
+            self._regex = re.compile(r'(?<!\w)(?:{0})(?!\w)'.format('|'.join(alternatives)))
+        else:
+            self._regex = None
+        self.highlight = lru_cache(maxsize=cache_size)(self._highlight)
+
+    def _highlight(self, text):
+        if self._regex is None:
+            return text
+        return self._regex.sub(self._replace, text)
+
+    def _replace(self, match):
+        markup = self._markups[match.lastgroup]
+        return markup + match.group(0) + markup
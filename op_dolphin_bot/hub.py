@@ -0,0 +1,203 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from .open_project import OpenProjectURL, OpenProjectActivities
+
+# Atom filters whose name differs from the activity type of their entries (see ActivityClassifier):
+_FILTER_TYPES = {'wiki_edits': 'wiki'}
+
+
+class FeedHub:
+    """ Fetches the Atom feed of each project once for all its subscribers and fans the entries out by type
+
+    Every subscription (e.g. one DolphinBot per Slack channel) has its own activity filters. The hub requests the feed
+    with the union of the filters, so the number of upstream requests depends on the number of projects only.
+    Each entry is classified once by the feed reader and is then handed to every subscription that wants its type.
+    Entries of unknown types (e.g. custom modules) are handed to all subscriptions, nothing is lost.
+    """
+
+    def __init__(self, transport=None, classifier=None):
+        """
+        Creates a FeedHub.
+
+        :param transport: Optional (shared) transport.HTTPTransport for the feed requests
+        :param classifier: ActivityClassifier used for all feeds (default: built-in types only)
+        """
+        self.transport = transport
+        self._classifier = classifier
+        self._feeds = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, op_url_builder, rss_key, activity_filters=None, max_age=0, backfill=None,
+                  last_deliver_time=None):
+        """
+        Subscribes to the activities of a project. The first subscription of a project loads its feed initially
+        (blocking, raises URLError like OpenProjectActivities).
+
+        :param op_url_builder: OpenProjectURL of the project
+        :param rss_key: RSS/Atom key (see Profile -> Tokens)
+        :param activity_filters: Activity types the subscription receives (default: all types)
+        :param max_age: A fetch of another subscription that is younger than N seconds is good enough, i.e.
+                        deliver_updates only fetches the feed again if the last fetch is older
+        :param backfill: Optional api.ActivityBackfill for the shared feed (the first one passed for a project is used)
+        :param last_deliver_time: Resumes after the given time (see FeedSubscription.cursor) instead of loading the
+                                  feed initially. The shared feed resumes from the oldest time of its subscriptions,
+                                  every subscription only receives the entries after its own time.
+        :return: FeedSubscription, which can be used like OpenProjectActivities (deliver_updates)
+        """
+        key = (op_url_builder.base_url, str(op_url_builder.project_id), rss_key)
+        with self._lock:
+            feed = self._feeds.get(key)
+            if feed is None:
+                feed = self._feeds[key] = _SharedFeed(op_url_builder, rss_key, self.transport, self._classifier)
+        return feed.subscribe(activity_filters, max_age, backfill, last_deliver_time)
+
+    @property
+    def stats(self):
+        with self._lock:
+            feeds = list(self._feeds.values())
+        return {'projects': len(feeds),
+                'subscriptions': sum(len(feed.subscriptions) for feed in feeds),
+                'fetches': sum(feed.stats['fetches'] for feed in feeds if feed.stats)}
+
+
+class FeedSubscription:
+    """ View of a shared feed that only delivers the entries of the subscribed types """
+
+    def __init__(self, feed, activity_filters, max_age, last_deliver_time=None, delivered_keys=None):
+        self._feed = feed
+        self.activity_filters = tuple(activity_filters)
+        self.types = frozenset(_FILTER_TYPES.get(f, f) for f in self.activity_filters)
+        self.max_age = max_age
+        # Entries up to this time have been delivered (when resuming, e.g. older than the shared feed's cursor):
+        self._since = last_deliver_time
+        # Change keys of the delivered entries at _since, all of that second count as delivered if unknown (None):
+        self._since_keys = delivered_keys
+        self._pending = []
+
+    def deliver_updates(self):
+        """ Returns the new entries of the subscribed types since the last call (newest first) """
+        return self._feed.deliver(self)
+
+    @property
+    def stats(self):
+        """ Statistics of the shared feed reader (see OpenProjectActivities.stats) """
+        return self._feed.stats
+
+    @property
+    def cursor(self):
+        """ Where this subscription would resume (see OpenProjectActivities.cursor). The shared cursor moves on as
+        soon as the feed is fetched, so entries that are still waiting for this subscription hold it back. """
+        return self._feed.subscription_cursor(self)
+
+
+class _SharedFeed:
+    def __init__(self, op_url_builder, rss_key, transport, classifier):
+        self._url_builder = op_url_builder
+        self._rss_key = rss_key
+        self._transport = transport
+        self._classifier = classifier
+        self._filters = []
+        self._types = frozenset()
+        self._reader = None
+        self._backfill = None
+        self._fetched_at = None
+        self.subscriptions = []
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self):
+        return self._reader.stats if self._reader is not None else None
+
+    @property
+    def cursor(self):
+        return self._reader.cursor if self._reader is not None else None
+
+    def subscribe(self, activity_filters, max_age, backfill, last_deliver_time):
+        if activity_filters is None:
+            activity_filters = OpenProjectURL.ACTIVITY_FILTERS
+        with self._lock:
+            missing = [f for f in activity_filters if f not in self._filters]
+            if self._backfill is None and backfill is not None:
+                self._backfill = backfill
+                if self._reader is not None:
+                    self._reader._backfill = backfill
+            # A subscription that resumes from an older time than the shared feed needs the entries in between:
+            behind = last_deliver_time is not None and self.cursor is not None and last_deliver_time < self.cursor
+            if missing or behind or self._reader is None:
+                self._reopen(self._filters + missing, last_deliver_time)
+            # A new subscription starts where the shared feed is, it never receives older entries (e.g. if the feed is
+            # rewound for a resuming subscription later):
+            if last_deliver_time is not None:
+                subscription = FeedSubscription(self, activity_filters, max_age, last_deliver_time)
+            else:
+                keys = self._reader.cursor_keys
+                subscription = FeedSubscription(self, activity_filters, max_age, self.cursor,
+                                                set(keys) if keys is not None else None)
+            self.subscriptions.append(subscription)
+            return subscription
+
+    def subscription_cursor(self, subscription):
+        with self._lock:
+            if subscription._pending:
+                # Resuming just before the oldest entry that is still waiting delivers it again:
+                return min(entry.datetime for entry in subscription._pending) - timedelta(microseconds=1)
+            cursor = self.cursor
+            if subscription._since is not None and (cursor is None or subscription._since < cursor):
+                return subscription._since
+            return cursor
+
+    def deliver(self, subscription):
+        with self._lock:
+            if self._fetched_at is None or time.monotonic() - self._fetched_at >= subscription.max_age:
+                self._fan_out(self._reader.deliver_updates())
+                self._fetched_at = time.monotonic()
+            entries, subscription._pending = subscription._pending, []
+            return entries
+
+    def _reopen(self, activity_filters, last_deliver_time=None):
+        # The feed URL contains the filters, so a subscription with new filters needs a new reader:
+        atom_url = self._url_builder.build_activity_atom_url(self._rss_key, activity_filters)
+        cursor_keys = None
+        if self._reader is not None:
+            logging.info("Extending the shared feed of project %s to: %s",
+                         self._url_builder.project_id, ', '.join(activity_filters))
+            # Hand out what the old reader did not deliver yet, the new one continues from there (or from the older
+            # time of a resuming subscription, the others skip the entries they already had, see _fan_out):
+            self._fan_out(self._reader.deliver_updates())
+            if last_deliver_time is None or self._reader.cursor <= last_deliver_time:
+                last_deliver_time, cursor_keys = self._reader.cursor, self._reader.cursor_keys
+        self._reader = OpenProjectActivities(atom_url, transport=self._transport, classifier=self._classifier,
+                                             backfill=self._backfill, last_deliver_time=last_deliver_time,
+                                             cursor_keys=cursor_keys)
+        self._fetched_at = time.monotonic()
+        self._filters = list(activity_filters)
+        self._types = frozenset(_FILTER_TYPES.get(f, f) for f in self._filters)
+
+    def _fan_out(self, entries):
+        if not entries:
+            return
+        for subscription in self.subscriptions:
+            wanted = [entry for entry in entries if (entry.type in subscription.types or entry.type not in self._types)
+                      and self._is_new(subscription, entry)]
+            if subscription._since is not None:
+                if entries[0].datetime > subscription._since:
+                    # The entries are newest first, everything up to the newest one has reached the subscription now:
+                    subscription._since, subscription._since_keys = entries[0].datetime, set()
+                if subscription._since_keys is not None:
+                    subscription._since_keys.update(entry.change_key() for entry in entries
+                                                    if entry.datetime == subscription._since)
+            if wanted:
+                # Entries of one fetch are newest first, so a newer fetch goes in front of the pending entries:
+                subscription._pending = wanted + subscription._pending
+
+    @staticmethod
+    def _is_new(subscription, entry):
+        # The feed has a resolution of seconds: entries of the same second as _since may still be new
+        since = subscription._since
+        if since is None or entry.datetime > since:
+            return True
+        return entry.datetime == since and subscription._since_keys is not None \
+            and entry.change_key() not in subscription._since_keys
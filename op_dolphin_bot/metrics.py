@@ -0,0 +1,291 @@
+import collections
+import logging
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Counter:
+    """ Monotonically increasing value, e.g. the number of retries """
+    TYPE = 'counter'
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        yield self.name, self.labels, self.value
+
+
+class Gauge(Counter):
+    """ Value that can go up and down, e.g. the depth of a queue """
+    TYPE = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class Histogram:
+    """ Distribution of observed values (e.g. latencies in seconds) in cumulative buckets """
+    TYPE = 'histogram'
+
+    def __init__(self, name, labels, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.labels = labels
+        self._buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self._buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = 0
+        for bound in self._buckets:
+            if value <= bound:
+                break
+            index += 1
+        with self._lock:
+            self._counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """ Context manager that observes the duration of its block """
+        return _Timer(self)
+
+    def samples(self):
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self.sum, self.count
+        cumulative = 0
+        for bound, bucket_count in zip(self._buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            le = '+Inf' if bound == float('inf') else repr(float(bound))
+            yield self.name + '_bucket', self.labels + (('le', le),), cumulative
+        yield self.name + '_sum', self.labels, total
+        yield self.name + '_count', self.labels, count
+
+
+class _Timer:
+    __slots__ = ('_histogram', '_start')
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+class MetricsRegistry:
+    """ Holds all metrics and renders them in the Prometheus text format """
+
+    def __init__(self):
+        self._metrics = collections.OrderedDict()
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, documentation, labels=None):
+        return self._get(Counter, name, documentation, labels)
+
+    def gauge(self, name, documentation, labels=None):
+        return self._get(Gauge, name, documentation, labels)
+
+    def histogram(self, name, documentation, labels=None, buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, documentation, labels, buckets)
+
+    def _get(self, metric_class, name, documentation, labels, *args):
+        labels = tuple(sorted((labels or {}).items()))
+        with self._lock:
+            metric = self._metrics.get((name, labels))
+            if metric is None:
+                metric = self._metrics[(name, labels)] = metric_class(name, labels, *args)
+                self._help[name] = (metric_class.TYPE, documentation)
+            elif not isinstance(metric, metric_class):
+                raise ValueError("Metric {0} is already registered as {1}.".format(name, metric.TYPE))
+            return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        described = set()
+        for metric in sorted(metrics, key=lambda m: m.name):
+            if metric.name not in described:
+                described.add(metric.name)
+                metric_type, documentation = self._help[metric.name]
+                lines.append("# HELP {0} {1}".format(metric.name, documentation))
+                lines.append("# TYPE {0} {1}".format(metric.name, metric_type))
+            for name, labels, value in metric.samples():
+                if labels:
+                    label_text = ','.join('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                          for k, v in labels)
+                    lines.append("{0}{{{1}}} {2}".format(name, label_text, value))
+                else:
+                    lines.append("{0} {1}".format(name, value))
+        return '\n'.join(lines) + '\n'
+
+
+# Registry used by the bot's instrumentation:
+REGISTRY = MetricsRegistry()
+
+
+class SamplingProfiler:
+    """ Statistical profiler for all threads, which can be toggled at runtime
+
+    While running, a background thread samples the stacks of all other threads every `interval` seconds.
+    Unlike cProfile, it sees every thread (bots, dispatchers, executors). When stopped, it costs nothing.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._self_counts = collections.Counter()
+        self._total_counts = collections.Counter()
+        self._samples = 0
+        self._started = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return False
+            self._reset()
+            self._started = time.monotonic()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._sample_forever, name="SamplingProfiler", daemon=True)
+            self._thread.start()
+            logging.info("Sampling profiler started.")
+            return True
+
+    def stop(self, limit=30):
+        """ Stops profiling and returns the report (see report) """
+        with self._lock:
+            if self._thread is None:
+                return "Profiler is not running.\n"
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            logging.info("Sampling profiler stopped.")
+            return self.report(limit)
+
+    def report(self, limit=30):
+        """ Lists the functions with the most samples: "self" = on top of the stack, "total" = anywhere in it """
+        if self._started is None:
+            return "Profiler has not been started yet.\n"
+        lines = ["{0} samples in {1:.1f} seconds".format(self._samples, time.monotonic() - self._started),
+                 "{0:>8} {1:>8}  function".format("self %", "total %")]
+        samples = max(1, self._samples)
+        for function, count in self._total_counts.most_common(limit):
+            lines.append("{0:>8.1f} {1:>8.1f}  {2}".format(100 * self._self_counts[function] / samples,
+                                                           100 * count / samples, function))
+        return '\n'.join(lines) + '\n'
+
+    def _sample_forever(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                self._samples += 1
+                self._self_counts[self._describe(frame)] += 1
+                seen = set()
+                while frame is not None:
+                    function = self._describe(frame)
+                    if function not in seen:
+                        seen.add(function)
+                        self._total_counts[function] += 1
+                    frame = frame.f_back
+
+    @staticmethod
+    def _describe(frame):
+        code = frame.f_code
+        return "{0} ({1}:{2})".format(code.co_name, code.co_filename, code.co_firstlineno)
+
+
+class MetricsServer:
+    """ Tiny HTTP server (stdlib only) that exposes the metrics for Prometheus
+
+    Endpoints:
+        /metrics                        Metrics in the Prometheus text format
+        /debug/profile?action=start     Starts the sampling profiler (only if profiling is enabled)
+        /debug/profile?action=stop      Stops the profiler and returns the report
+    """
+
+    def __init__(self, port=9100, host='127.0.0.1', registry=REGISTRY, enable_profiling=False):
+        self.registry = registry
+        self.profiler = SamplingProfiler() if enable_profiling else None
+        self._server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        self._server.metrics_server = self
+        self.port = self._server.server_address[1]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="MetricsServer", daemon=True)
+        self._thread.start()
+        logging.info("Serving metrics on port %i.", self.port)
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """ HTTPServer that handles every connection in a daemon thread (metrics, webhooks and the stand-ins) """
+    daemon_threads = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        metrics_server = self.server.metrics_server
+        url = urlsplit(self.path)
+        if url.path == '/metrics':
+            self._respond(200, metrics_server.registry.render(), 'text/plain; version=0.0.4')
+        elif url.path == '/debug/profile' and metrics_server.profiler is not None:
+            action = parse_qs(url.query).get('action', [''])[0]
+            if action == 'start':
+                started = metrics_server.profiler.start()
+                self._respond(200, "Profiler started.\n" if started else "Profiler is already running.\n")
+            elif action == 'stop':
+                self._respond(200, metrics_server.profiler.stop())
+            else:
+                self._respond(400, "Use ?action=start or ?action=stop.\n")
+        else:
+            self._respond(404, "Not found.\n")
+
+    def _respond(self, status, text, content_type='text/plain; charset=utf-8'):
+        body = text.encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
@@ -1,24 +1,74 @@
-from datetime import datetime, timedelta, timezone
 import xml.etree.ElementTree as ElemTree
 import urllib.request
 import logging
+import gzip
+import zlib
+from urllib.parse import urlsplit
+
+from . import metrics
+from .activity import Activity, parse_rfc3339
+
+_FETCH_SECONDS = metrics.REGISTRY.histogram('dolphin_feed_fetch_seconds',
+                                            "Duration of Atom feed requests (including parsing)")
+_PARSE_SECONDS = metrics.REGISTRY.histogram('dolphin_feed_parse_seconds',
+                                            "Duration of incrementally parsing (and reading) an Atom feed response")
+_ENTRY_BUILD_SECONDS = metrics.REGISTRY.histogram('dolphin_entry_build_seconds', "Duration of building one entry",
+                                                  buckets=(.00001, .000025, .00005, .0001, .00025, .0005, .001, .01))
+_FEED_BYTES = metrics.REGISTRY.counter('dolphin_feed_received_bytes_total', "Bytes received from the Atom feed")
+_FEED_NOT_MODIFIED = metrics.REGISTRY.counter('dolphin_feed_not_modified_total', "Atom feed requests answered by 304")
+_FEED_ERRORS = metrics.REGISTRY.counter('dolphin_feed_errors_total', "Failed Atom feed requests")
+_FEED_GAPS = metrics.REGISTRY.counter('dolphin_feed_gaps_total',
+                                      "Fetches whose entries did not reach back to the last delivered entry")
 
 
 class OpenProjectActivities:
     """ Basically a tiny feed reader - it is used to read the OpenProject activities (atom feed) """
 
-    _PREFIX = {'feed': 'http://www.w3.org/2005/Atom'}
-    _TAGS = {'feed:title': 'title',
-             'feed:id': 'url',
-             'feed:updated': 'datetime',
-             'feed:author/feed:name': 'author'}
+    _ENTRY_TAG = '{http://www.w3.org/2005/Atom}entry'
+    _UPDATED_TAG = '{http://www.w3.org/2005/Atom}updated'
+    _TITLE_TAG = '{http://www.w3.org/2005/Atom}title'
+    _ID_TAG = '{http://www.w3.org/2005/Atom}id'
+    _AUTHOR_TAG = '{http://www.w3.org/2005/Atom}author'
+    _NAME_TAG = '{http://www.w3.org/2005/Atom}name'
+
+    def __init__(self, atom_url, transport=None, classifier=None, backfill=None, last_deliver_time=None,
+                 cursor_keys=None):
+        """
+        Creates an OpenProjectActivities feed reader and initially loads the feed (unless it resumes).
 
-    def __init__(self, atom_url):
+        :param atom_url: URL of the Atom activity feed (see OpenProjectURL.build_activity_atom_url)
+        :param transport: Optional (shared) transport.HTTPTransport, urllib.request.urlopen is used otherwise
+        :param classifier: ActivityClassifier which determines the type of the entries (default: built-in types only)
+        :param backfill: Optional api.ActivityBackfill that recovers the entries of a gap (see deliver_updates)
+        :param last_deliver_time: Resumes after the given time (see `cursor`, e.g. from a checkpoint.Checkpoint):
+                                  the initial fetch is skipped and the first deliver_updates returns everything newer.
+        :param cursor_keys: Change keys of the entries delivered at last_deliver_time (see `cursor_keys`), otherwise
+                            all entries of that second count as delivered.
+        """
         self._atom_url = atom_url
+        self._classifier = classifier if classifier is not None else DEFAULT_CLASSIFIER
+        self._urlopen = transport.urlopen if transport is not None else urllib.request.urlopen
 
         self._update_time = None
         self._last_deliver_time = None
-        self._xml_entries = None
+        self._new_entries = []
+        # Change keys of the delivered entries at _last_deliver_time (None if unknown, i.e. after resuming):
+        self._cursor_keys = set(cursor_keys) if cursor_keys is not None else None
+        self._backfill = backfill
+        # (last delivered time, oldest new entry time) if the last parse did not reach a delivered entry:
+        self._gap = None
+
+        # Validators of the last successful response, used for conditional requests (see _refresh_xml_entries):
+        self._etag = None
+        self._last_modified = None
+        # Counters to check how much bandwidth/CPU the conditional requests save:
+        self.stats = {'fetches': 0, 'bytes_received': 0, 'not_modified': 0, 'full_parses': 0, 'parsed_entries': 0,
+                      'gaps': 0, 'backfilled_entries': 0}
+
+        if last_deliver_time is not None:
+            logging.debug("Resuming Atom feed after %s: %s", last_deliver_time, self._atom_url)
+            self._update_time = self._last_deliver_time = last_deliver_time
+            return
 
         logging.debug("Trying to initially load Atom feed: %s", self._atom_url)
         if not self._refresh_xml_entries():
@@ -30,29 +80,97 @@ class OpenProjectActivities:
         # Those entries are excluded from the first call of "deliver_updates" by marking the entries as delivered:
         self._last_deliver_time = self._update_time  # append for testing purposes: "- timedelta(minutes=200)"
 
+    @property
+    def cursor(self):
+        """ Update time of the last delivered entries, i.e. where a new reader would resume """
+        return self._last_deliver_time
+
+    @property
+    def cursor_keys(self):
+        """ Change keys of the delivered entries at the cursor (see Activity.change_key), None if unknown """
+        return frozenset(self._cursor_keys) if self._cursor_keys is not None else None
+
     def deliver_updates(self):
         result = []
         # Only if refreshing is successful:
         if self._refresh_xml_entries():
-            # If there are new items:
-            if self._last_deliver_time < self._update_time:
+            # If there are new items (they may share the second of the last delivered ones):
+            if self._new_entries or self._last_deliver_time < self._update_time:
                 logging.info("Got updates, update time: %s", self._update_time)
-                for entry in self._xml_entries:
-                    # Only append the newest items:
-                    if self._last_deliver_time < self._convert_time(entry):
-                        result.append(self._build_entry(entry))
-                self._last_deliver_time = self._update_time
+                # The parser already stopped at the first entry that has been delivered before:
+                result = self._new_entries
+                self._new_entries = []
+                if self._gap is not None:
+                    result = self._fill_gap(result, *self._gap)
+                    self._gap = None
+                self._advance_cursor(result)
         return result
 
+    def _advance_cursor(self, entries):
+        """ Marks the entries as delivered. The feed has a resolution of seconds, so the change keys of the entries
+        at the cursor are remembered: later entries of the same second are still new (see _parse_entries). """
+        if self._last_deliver_time < self._update_time:
+            self._last_deliver_time = self._update_time
+            self._cursor_keys = set()
+        if self._cursor_keys is not None:
+            self._cursor_keys.update(entry.change_key() for entry in entries
+                                     if entry.datetime == self._last_deliver_time)
+
+    def _fill_gap(self, entries, since, until):
+        """ Merges the entries between the last delivery and the oldest new entry (see ActivityBackfill) """
+        self.stats['gaps'] += 1
+        _FEED_GAPS.inc()
+        if self._backfill is None:
+            logging.warning("The Atom feed is too short: activities between %s and %s are missing. "
+                            "Poll more often or configure an API key for the backfill.", since, until)
+            return entries
+        try:
+            missing = self._backfill.fetch(since, until)
+        except (urllib.request.URLError, OSError, ValueError, KeyError) as err:
+            logging.error("Unable to backfill the activities between %s and %s. More info: %s", since, until, err)
+            return entries
+        logging.info("Backfilled %i activities between %s and %s via the API.", len(missing), since, until)
+        # The bounds are inclusive (see ActivityBackfill.fetch), so drop what the feed delivers now or did before:
+        known = {entry.change_key() for entry in entries}
+        missing = [entry for entry in missing if entry.change_key() not in known and not self._delivered_at(entry)]
+        self.stats['backfilled_entries'] += len(missing)
+        # The backfilled entries are older than all new entries, so "newest first" is preserved:
+        return entries + missing
+
+    def _delivered_at(self, entry):
+        """ Whether the entry is one of the delivered ones at the cursor (all are, if their keys are unknown) """
+        if entry.datetime != self._last_deliver_time:
+            return entry.datetime < self._last_deliver_time
+        return self._cursor_keys is None or entry.change_key() in self._cursor_keys
+
     def _refresh_xml_entries(self):
+        with _FETCH_SECONDS.time():
+            is_refreshed = self._fetch_and_parse()
+        if not is_refreshed:
+            _FEED_ERRORS.inc()
+        return is_refreshed
+
+    def _fetch_and_parse(self):
+        self.stats['fetches'] += 1
         try:
-            with urllib.request.urlopen(self._atom_url) as atom_file:
-                root = ElemTree.fromstring(atom_file.read().decode('utf8'))
-            self._update_time = self._convert_time(root)
-            if self._last_deliver_time is not None and self._update_time > self._last_deliver_time:
-                self._xml_entries = root.findall('feed:entry', self._PREFIX)
+            with self._urlopen(self._build_request()) as atom_file:
+                stream = _CountingReader(atom_file)
+                self._parse_feed(self._decoding_reader(stream, atom_file.headers.get('Content-Encoding')))
+                logging.debug("Received %i bytes of Atom feed (%s).", stream.count,
+                              atom_file.headers.get('Content-Encoding', 'identity'))
+                self.stats['bytes_received'] += stream.count
+                _FEED_BYTES.inc(stream.count)
+                # Only remember the validators after a successful parse, otherwise we could miss entries with a 304:
+                self._etag = atom_file.headers.get('ETag', self._etag)
+                self._last_modified = atom_file.headers.get('Last-Modified', self._last_modified)
             return True
         except urllib.request.HTTPError as http_err:
+            if http_err.code == 304:
+                # Feed did not change since the last fetch, so there is nothing to parse:
+                self.stats['not_modified'] += 1
+                _FEED_NOT_MODIFIED.inc()
+                logging.debug("Atom feed not modified since last fetch.")
+                return True
             logging.error("Error while executing HTTP request to OpenProject (Status: %i). "
                           "More info: %s", http_err.code, http_err)
             return False
@@ -60,42 +178,135 @@ class OpenProjectActivities:
             logging.error("Unable to read from OpenProject. Probably not connected to the internet or wrong URL."
                           " More info: %s", url_err)
             return False
+        except (ElemTree.ParseError, OSError, EOFError) as parse_err:
+            logging.error("Unable to parse the Atom feed of OpenProject. More info: %s", parse_err)
+            return False
 
-    @staticmethod
-    def guess_activity_type(url):
-        """ Guesses the type (e.g. work_packages).
-        First, the given URL is split into parts. Then, it is checked for type occurrences in the URL (file) path.
-        The "rightmost" matching path part will the resulting type.
+    def _parse_feed(self, stream):
+        """ Incrementally parses the feed and only builds the entries that are newer than the last delivered one.
 
-        Examples:
-            ".../work_packages/21" -> will return "work_packages"
-            ".../work_packages/21/time_entries" -> will return "time_entries", not "work_packages"!
+        OpenProject lists the newest entries first, so parsing stops at the first entry that is older. Entries of the
+        same second as the last delivered one are only new if their change key is unknown (see _advance_cursor).
+        Before the first delivery (no _last_deliver_time yet) only the entries of the newest second are built.
         """
-        parts = url.split("/")
-        index = -1
-        guessed = None
-        for p in enumerate(parts):
-            for name in OpenProjectURL.ACTIVITY_FILTERS:
-                if name in p and index < p[0]:
-                    guessed = p[1]
-                    index = p[0]
-        return guessed
+        self.stats['full_parses'] += 1
+        with _PARSE_SECONDS.time():
+            self._new_entries = self._parse_entries(stream)
+
+    def _parse_entries(self, stream):
+        new_entries = []
+        self._gap = None
+        initial_keys = set() if self._last_deliver_time is None else None
+        reached_delivered = False
+        depth = 0
+        for event, elem in ElemTree.iterparse(stream, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            # Only direct children of <feed> are interesting:
+            if depth != 1:
+                continue
+            if elem.tag == self._UPDATED_TAG:
+                self._update_time = parse_rfc3339(elem.text)
+                if self._last_deliver_time is not None and self._update_time < self._last_deliver_time:
+                    break
+            elif elem.tag == self._ENTRY_TAG:
+                with _ENTRY_BUILD_SECONDS.time():
+                    entry = self._build_entry(elem)
+                elem.clear()
+                if initial_keys is not None:
+                    # Initial load: the entries of the newest second become the delivered ones at the cursor
+                    if entry.datetime < self._update_time:
+                        break
+                    initial_keys.add(entry.change_key())
+                elif self._delivered_at(entry):
+                    reached_delivered = True
+                    if entry.datetime < self._last_deliver_time:
+                        break
+                else:
+                    new_entries.append(entry)
+                    self.stats['parsed_entries'] += 1
+        if initial_keys is not None:
+            self._cursor_keys = initial_keys
+        elif new_entries and not reached_delivered:
+            # All entries are new, so the feed (limited to the newest N entries) may have dropped older ones:
+            self._gap = (self._last_deliver_time, new_entries[-1].datetime)
+        return new_entries
+
+    @staticmethod
+    def _decoding_reader(stream, encoding):
+        if encoding == 'gzip':
+            return gzip.GzipFile(fileobj=stream)
+        elif encoding == 'deflate':
+            return _InflateReader(stream)
+        return stream
+
+    def _build_request(self):
+        headers = {'Accept-Encoding': "gzip, deflate"}
+        if self._etag is not None:
+            headers['If-None-Match'] = self._etag
+        if self._last_modified is not None:
+            headers['If-Modified-Since'] = self._last_modified
+        return urllib.request.Request(self._atom_url, headers=headers)
+
+    @staticmethod
+    def guess_activity_type(url):
+        """ Guesses the type (e.g. work_packages) with the built-in types. See ActivityClassifier.classify. """
+        return DEFAULT_CLASSIFIER.classify(url)
 
     def _build_entry(self, xml_entry):
-        entry = {}
-        for kv in self._TAGS.items():
-            entry[kv[1]] = xml_entry.find(kv[0], self._PREFIX).text
-        entry['type'] = OpenProjectActivities.guess_activity_type(entry['url'])
-        entry['datetime'] = self._convert_time(xml_entry)
-        return entry
-
-    def _convert_time(self, xml_entry, to_local_tz=True):
-        # Assuming Zulu UTC (+0) military time zone in Atom feed, that's what the 'Z' stands for at the end:
-        dt = datetime.strptime(xml_entry.find('feed:updated', self._PREFIX).text, "%Y-%m-%dT%H:%M:%SZ")
-        if to_local_tz:
-            return dt.replace(tzinfo=timezone.utc).astimezone(tz=None)
-        else:
-            return dt
+        # A single pass over the children instead of one find() per field:
+        title = url = updated = author = None
+        for child in xml_entry:
+            if child.tag == self._TITLE_TAG:
+                title = child.text
+            elif child.tag == self._ID_TAG:
+                url = child.text
+            elif child.tag == self._UPDATED_TAG:
+                updated = child.text
+            elif child.tag == self._AUTHOR_TAG:
+                author = child.findtext(self._NAME_TAG)
+        # Assuming Zulu UTC (+0) military time zone in Atom feed, converted to the local time zone:
+        return Activity(title, url, parse_rfc3339(updated), author, self._classifier.classify(url))
+
+
+class _CountingReader:
+    """ File-like wrapper that counts the bytes read from the (possibly compressed) response """
+
+    def __init__(self, raw):
+        self._raw = raw
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self._raw.read(size)
+        self.count += len(data)
+        return data
+
+
+class _InflateReader:
+    """ File-like wrapper that incrementally decompresses a "deflate" encoded response """
+
+    def __init__(self, raw, chunk_size=16 * 1024):
+        self._raw = raw
+        self._chunk_size = chunk_size
+        self._inflater = None
+        self._eof = False
+
+    def read(self, size=-1):
+        while not self._eof:
+            chunk = self._raw.read(self._chunk_size)
+            if self._inflater is None:
+                # Some servers send a raw deflate stream instead of the zlib format demanded by the RFC:
+                is_zlib = len(chunk) >= 2 and (chunk[0] & 0x0f) == 8 and ((chunk[0] << 8) + chunk[1]) % 31 == 0
+                self._inflater = zlib.decompressobj(zlib.MAX_WBITS if is_zlib else -zlib.MAX_WBITS)
+            if not chunk:
+                self._eof = True
+                return self._inflater.flush()
+            data = self._inflater.decompress(chunk)
+            if data:
+                return data
+        return b''
 
 
 class OpenProjectURL:
@@ -123,4 +334,56 @@ class OpenProjectURL:
 
     @staticmethod
     def part_to_text(url_part):
+        if url_part is None:
+            return "Other"
         return url_part.replace('_', ' ').capitalize()
+
+
+class ActivityClassifier:
+    """ Determines the activity type (e.g. work_packages) of an URL by looking up its path segments in an index """
+
+    def __init__(self, segment_types=None, cache_size=4096):
+        """
+        Creates an ActivityClassifier.
+
+        :param segment_types: Additional path segments mapped to activity types, e.g. for OpenProject instances with
+                              custom modules: {'boards': 'forums', 'topics': 'forums', 'versions': 'versions'}.
+                              SlackMessageBuilder falls back to a default look for types it does not know.
+        :param cache_size: Maximum number of memoized URL prefixes
+        """
+        self._index = {name: name for name in OpenProjectURL.ACTIVITY_FILTERS}
+        if segment_types:
+            self._index.update(segment_types)
+        self._cache_size = cache_size
+        self._cache = {}
+
+    def classify(self, url):
+        """ Returns the type of the "rightmost" path segment with a known type, None if there is none.
+
+        Examples:
+            ".../work_packages/21" -> will return "work_packages"
+            ".../work_packages/21/time_entries" -> will return "time_entries", not "work_packages"!
+        """
+        if url is None:
+            return None
+        path = urlsplit(url).path
+        # Memoize per prefix: the trailing ID does not change the type (".../work_packages/21" -> ".../work_packages")
+        prefix, _, last = path.rpartition('/')
+        if not last.isdigit():
+            prefix = path
+        try:
+            return self._cache[prefix]
+        except KeyError:
+            pass
+        guessed = None
+        for segment in reversed(prefix.split('/')):
+            guessed = self._index.get(segment)
+            if guessed is not None:
+                break
+        if len(self._cache) >= self._cache_size:
+            self._cache.clear()
+        self._cache[prefix] = guessed
+        return guessed
+
+
+DEFAULT_CLASSIFIER = ActivityClassifier()
@@ -0,0 +1,335 @@
+import atexit
+import base64
+import collections
+import difflib
+import gzip
+import http.client
+import io
+import json
+import logging
+import random
+import re
+import threading
+import time
+import urllib.request
+import zlib
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from .dolphin_bot import DolphinBot
+from .slack import SlackMessageBuilder
+
+# Response headers that are recorded, the others do not change what the bot does:
+RECORDED_HEADERS = ('Content-Type', 'Content-Encoding', 'ETag', 'Last-Modified', 'Retry-After')
+# Query parameters whose values are secrets (RSS key of the Atom feed):
+_SECRET_PARAMS = ('key', 'apikey', 'api_key', 'token')
+_REDACTED = '***'
+_ATOM_PATH = re.compile(r'^(?P<base>.*)/projects/(?P<project>[^/]+)/activity\.atom$')
+
+
+class Recorder:
+    """ Writes the HTTP traffic of the bot to a compressed log (gzip, one JSON object per line)
+
+    Every record has the wall time `t` of the request, the method and the URL (without secrets, see redact_url).
+    Responses are recorded with status, the headers that matter (RECORDED_HEADERS) and the raw body as it came over
+    the wire, e.g. still gzip compressed. Of a POST (Slack), the sent payload is recorded instead of the response body.
+    Lines are buffered and written at most every `flush_interval` seconds (and when closing, at the latest at exit).
+    """
+
+    def __init__(self, path, flush_interval=5.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._lines = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self.stats = {'records': 0}
+        atexit.register(self.close)
+
+    def record(self, record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._lines.append(line)
+            self.stats['records'] += 1
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        self._last_flush = time.monotonic()
+        if not self._lines:
+            return
+        # Every flush appends a complete gzip member, a killed bot only loses the records since the last flush and
+        # the file stays readable as a whole (gzip concatenates the members, see load_recording):
+        with open(self.path, 'ab') as recording:
+            recording.write(gzip.compress(''.join(self._lines).encode('utf8')))
+        self._lines = []
+
+    def close(self):
+        self.flush()
+        atexit.unregister(self.close)
+
+
+class RecordingTransport:
+    """ Transport (see transport.HTTPTransport) that records every request and response with a Recorder
+
+    Pass it as `transport` to a DolphinBot: the feed requests of OpenProjectActivities, the backfill requests and the
+    posts of SlackConnection are recorded. The response is read completely and handed on from memory.
+    """
+
+    def __init__(self, recorder, transport=None):
+        self.recorder = recorder
+        self._urlopen = transport.urlopen if transport is not None else urllib.request.urlopen
+
+    def urlopen(self, url, data=None, timeout=None):
+        request = url if isinstance(url, urllib.request.Request) else urllib.request.Request(url)
+        if data is not None:
+            request.data = data
+        method = request.get_method()
+        record = {'t': time.time(), 'method': method, 'url': redact_url(request.full_url, method)}
+        if request.data is not None:
+            record['request'] = request.data.decode('utf8', 'replace')
+        try:
+            kwargs = {'timeout': timeout} if timeout is not None else {}
+            with self._urlopen(request, **kwargs) as response:
+                body = response.read()
+                status, headers = response.status, response.headers
+        except urllib.request.HTTPError as http_err:
+            body = http_err.read()
+            self.recorder.record(_response_record(record, http_err.code, http_err.headers, body))
+            raise urllib.request.HTTPError(request.full_url, http_err.code, http_err.reason, http_err.headers,
+                                           io.BytesIO(body))
+        except urllib.request.URLError as url_err:
+            record['error'] = str(url_err.reason)
+            self.recorder.record(record)
+            raise
+        self.recorder.record(_response_record(record, status, headers, body))
+        return RecordedResponse(request.full_url, status, headers, body)
+
+
+class RecordedResponse:
+    """ Response from memory with the interface of urlopen's responses (as used by the bot) """
+
+    def __init__(self, url, status, headers, body):
+        self.url = url
+        self.status = status
+        self.reason = http.client.responses.get(status, '')
+        self.headers = headers
+        self._body = io.BytesIO(body)
+
+    def getcode(self):
+        return self.status
+
+    def read(self, size=-1):
+        return self._body.read(size)
+
+    def close(self):
+        self._body.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class VirtualClock:
+    """ Clock for DolphinBot (time(), monotonic() and sleep()) whose time only moves when being advanced
+
+    Without `speed`, sleeping and advancing take no real time (replay at maximum speed). With speed=1.0, the replay
+    waits as long as the recording took, with speed=10.0 ten times faster.
+    """
+
+    def __init__(self, start, speed=None):
+        self.speed = speed
+        self._now = start
+
+    def time(self):
+        return self._now
+
+    def monotonic(self):
+        return self._now
+
+    def sleep(self, seconds):
+        self.advance_to(self._now + seconds)
+
+    def advance_to(self, timestamp):
+        if timestamp <= self._now:
+            return
+        if self.speed:
+            time.sleep((timestamp - self._now) / self.speed)
+        self._now = timestamp
+
+
+class ReplayTransport:
+    """ Transport that answers the requests of a recording without any network
+
+    The recorded responses of a URL are returned in their recorded order, the last one is repeated if the replay
+    requests the URL more often. Statuses other than 2xx are raised as HTTPError and recorded connection errors as
+    URLError, like the real transport does. Posts always succeed and are collected in `posted` (time and payload).
+    """
+
+    def __init__(self, records, clock):
+        self._clock = clock
+        self._responses = collections.defaultdict(collections.deque)
+        for record in records:
+            if record['method'] == 'GET':
+                self._responses[record['url']].append(record)
+        self.posted = []
+        self._lock = threading.Lock()
+
+    def urlopen(self, url, data=None, timeout=None):
+        request = url if isinstance(url, urllib.request.Request) else urllib.request.Request(url)
+        if data is not None:
+            request.data = data
+        if request.get_method() == 'POST':
+            with self._lock:
+                self.posted.append({'t': self._clock.time(), 'request': request.data.decode('utf8')})
+            return RecordedResponse(request.full_url, 200, _headers({}), b'ok')
+
+        with self._lock:
+            responses = self._responses.get(redact_url(request.full_url))
+            if not responses:
+                raise urllib.request.URLError("Not in the recording: {0}".format(request.full_url))
+            record = responses.popleft() if len(responses) > 1 else responses[0]
+        if 'error' in record:
+            raise urllib.request.URLError(record['error'])
+        headers = _headers(record.get('headers', {}))
+        body = base64.b64decode(record.get('body', ''))
+        if not 200 <= record['status'] < 300:
+            raise urllib.request.HTTPError(request.full_url, record['status'], http.client.responses.get(
+                record['status'], ''), headers, io.BytesIO(body))
+        return RecordedResponse(request.full_url, record['status'], headers, body)
+
+
+def load_recording(path):
+    """ Returns the records of a recording (see Recorder), in order of their time
+
+    If the bot was killed while flushing, the last gzip member has no end. The records before are read anyway, the
+    incomplete rest is skipped.
+    """
+    records = []
+    with gzip.open(path, 'rt', encoding='utf8') as recording:
+        try:
+            for line in recording:
+                if line.strip():
+                    records.append(json.loads(line))
+        except (EOFError, ValueError, zlib.error) as err:
+            logging.warning("The recording %s ends incompletely, replaying its first %i records. More info: %s",
+                            path, len(records), err)
+    return sorted(records, key=lambda r: r['t'])
+
+
+def replay(records, speed=None, seed=0, **bot_kwargs):
+    """
+    Feeds a recording through DolphinBot and returns the posted payloads as list of {'t': time, 'request': payload}.
+
+    There is one bot for every recorded Atom feed. It is created at the time of the first request of its feed (the
+    initial fetch), every later request of the feed is a refresh: the clock is advanced to its time, the entries are
+    processed and the messages are posted. The refresh rate of the recording is used, not the one of the scheduler.
+
+    :param records: Records of load_recording
+    :param speed: Replays at maximum speed if None, otherwise in real time multiplied by speed (see VirtualClock)
+    :param seed: Seed of the randomized parts of the messages (praise)
+    :param bot_kwargs: Further DolphinBot parameters, e.g. max_links and smart_summary_limit of the recorded bot
+    """
+    polls = [r for r in records if r['method'] == 'GET' and _ATOM_PATH.match(urlsplit(r['url']).path)]
+    if not polls:
+        return []
+    random.seed(seed)
+    clock = VirtualClock(polls[0]['t'], speed)
+    transport = ReplayTransport(records, clock)
+    api_paths = {urlsplit(r['url']).path for r in records if '/api/v3/' in r['url']}
+    bots = {}
+    for poll in polls:
+        clock.advance_to(poll['t'])
+        bot = bots.get(poll['url'])
+        if bot is None:
+            bots[poll['url']] = _create_bot(poll['url'], transport, clock, api_paths, bot_kwargs)
+            continue
+        for message, _ in bot.process_entries(bot.fetch_updates()):
+            bot.post(message)
+    return sorted(transport.posted, key=lambda p: p['t'])
+
+
+def recorded_posts(records):
+    """ Returns the successful posts of a recording (see replay) """
+    return [{'t': r['t'], 'request': r['request']} for r in records
+            if r['method'] == 'POST' and 200 <= r.get('status', 0) < 300]
+
+
+def diff_posts(expected, actual, ignore=('pre_praise',)):
+    """
+    Returns a unified diff (list of lines) between the payloads of two lists of posts, empty if they are the same.
+
+    :param ignore: Parts that differ between runs and are left out of the comparison. 'pre_praise' is the random
+                   praise in front of a summary (see slack.SlackMessageBuilder._TEXT_PRAISE).
+    """
+    return list(difflib.unified_diff(_payload_lines(expected, ignore), _payload_lines(actual, ignore),
+                                     'recorded', 'replayed', lineterm=''))
+
+
+def redact_url(url, method='GET'):
+    """ Removes the secrets from a URL: the values of key parameters, and the path of a POST target (Slack hook) """
+    parts = urlsplit(url)
+    if method == 'POST':
+        return urlunsplit((parts.scheme, parts.netloc, '/' + _REDACTED, '', ''))
+    query = [(name, _REDACTED if name.lower() in _SECRET_PARAMS else value)
+             for name, value in parse_qsl(parts.query, keep_blank_values=True)]
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query, safe='*'), parts.fragment))
+
+
+def _create_bot(atom_url, transport, clock, api_paths, bot_kwargs):
+    parts = urlsplit(atom_url)
+    match = _ATOM_PATH.match(parts.path)
+    query = parse_qsl(parts.query)
+    activity_filters = [name[len('show_'):] for name, _ in query if name.startswith('show_')]
+    op_base_url = urlunsplit((parts.scheme, parts.netloc, match.group('base'), '', ''))
+    project_id = match.group('project')
+    logging.info("Replaying the Atom feed of project %s at %s.", project_id, op_base_url)
+    # Only a bot whose backfill requests were recorded gets an API key, the others would not find their responses:
+    has_api = "{0}/api/v3/projects/{1}/work_packages".format(match.group('base'), project_id) in api_paths
+    kwargs = dict(transport=transport, clock=clock, op_api_key=_REDACTED if has_api else None)
+    kwargs.update(bot_kwargs)
+    return DolphinBot("https://replay.invalid/" + _REDACTED, op_base_url,
+                     int(project_id) if project_id.isdigit() else project_id, dict(query).get('key', _REDACTED),
+                     activity_filters, **kwargs)
+
+
+def _payload_lines(posts, ignore):
+    lines = []
+    for number, post in enumerate(posts, 1):
+        try:
+            payload = json.loads(post['request'])
+        except ValueError:
+            payload = post['request']
+        if isinstance(payload, dict) and 'pre_praise' in ignore and 'attachments' in payload:
+            payload['text'] = _strip_praise(payload.get('text', ''))
+        lines.append("--- message {0}".format(number))
+        lines.extend(json.dumps(payload, sort_keys=True, indent=1, ensure_ascii=False).splitlines())
+    return lines
+
+
+def _strip_praise(text):
+    # The longest praise first, "Huzzah! :star2:" must not leave a part of "Huzzah! :heart_eyes:" behind:
+    for praise in sorted((p for _, p in SlackMessageBuilder._TEXT_PRAISE), key=len, reverse=True):
+        if text.startswith(praise):
+            return text[len(praise):]
+    return text
+
+
+def _response_record(record, status, headers, body):
+    record = dict(record, status=status)
+    if headers is not None:
+        record['headers'] = {name: headers[name] for name in RECORDED_HEADERS if headers.get(name) is not None}
+    if record['method'] == 'GET':
+        record['body'] = base64.b64encode(body).decode('ascii')
+    return record
+
+
+def _headers(headers):
+    message = http.client.HTTPMessage()
+    for name, value in headers.items():
+        message[name] = value
+    return message
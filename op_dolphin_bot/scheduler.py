@@ -0,0 +1,86 @@
+import random
+import time
+
+
+class AdaptivePollScheduler:
+    """ Deadline based poll scheduler on a monotonic clock that adapts the interval to the feed activity
+
+    Deadlines are planned from the previous deadline, not from the end of the processing, so the period does not drift
+    by the processing time. The interval shrinks while the feed is busy and grows exponentially while it is idle,
+    always within [min_interval, max_interval]. Jitter spreads the polls of many bots.
+    """
+
+    def __init__(self, interval, min_interval=None, max_interval=None, speedup=0.5, backoff=1.5, jitter=0.1,
+                 clock=time.monotonic):
+        """
+        Creates an AdaptivePollScheduler.
+
+        :param interval: Base interval in seconds (the refresh rate)
+        :param min_interval: Lower bound for busy feeds (default: the base interval, i.e. no speedup)
+        :param max_interval: Upper bound for idle feeds (default: the base interval, i.e. no backoff)
+        :param speedup: Factor applied to the interval after a poll with new entries
+        :param backoff: Factor applied to the interval after a poll without new entries
+        :param jitter: Randomizes every interval by +/- this fraction
+        :param clock: Monotonic clock function
+        """
+        self.base_interval = interval
+        self.min_interval = interval if min_interval is None else min(min_interval, interval)
+        self.max_interval = interval if max_interval is None else max(max_interval, interval)
+        self.speedup = speedup
+        self.backoff = backoff
+        self.jitter = jitter
+        self.interval = interval
+        self.last_delay = interval
+        self._clock = clock
+        self._deadline = None
+        self._holding_back = False
+
+    def record(self, new_entries, holding_back=False):
+        """
+        Adapts the interval to the result of the last poll.
+
+        :param new_entries: Number of new entries of the last poll
+        :param holding_back: True if the smart summary is holding back entries. The next poll decides whether the feed
+                             "remained silent for one more interval", so the interval does not drop below the base.
+        """
+        if new_entries:
+            self.interval = max(self.min_interval, self.interval * self.speedup)
+        else:
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+        self._holding_back = holding_back
+        if holding_back:
+            self.interval = max(self.interval, self.base_interval)
+            now = self._clock()
+            if new_entries and self._deadline is not None and self._deadline > now:
+                # New entries after an early wake-up (pushed entries) restart the silence window of the smart summary,
+                # the deadline that was planned before they arrived would end it too early:
+                self._deadline = max(self._deadline, now + self.base_interval)
+                self.last_delay = self._deadline - now
+
+    def lateness(self):
+        """ Seconds the current poll started after its deadline (loop drift) """
+        if self._deadline is None:
+            return 0.0
+        return max(0.0, self._clock() - self._deadline)
+
+    def next_delay(self):
+        """ Returns the seconds to wait for the next deadline. A new deadline is only planned once the current one
+        has passed, so waking up early (e.g. for pushed entries) does not postpone the next poll. """
+        now = self._clock()
+        if self._deadline is None:
+            self._deadline = now
+        if self._deadline <= now:
+            # While the smart summary holds entries back, the feed has to remain silent for at least the base interval,
+            # so the jitter may only lengthen it:
+            delay = self.interval * random.uniform(1 if self._holding_back else 1 - self.jitter, 1 + self.jitter)
+            self._deadline += delay
+            if self._holding_back:
+                self._deadline = max(self._deadline, now + self.base_interval)
+            elif self._deadline < now:
+                # Processing took longer than the interval: poll right away instead of catching up on missed polls.
+                self._deadline = now
+            self.last_delay = self._deadline - now
+        return self._deadline - now
+
+    def wait(self, sleep=time.sleep):
+        sleep(self.next_delay())
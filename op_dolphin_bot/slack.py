@@ -2,20 +2,31 @@ import urllib.request
 import time
 import random
 import logging
-import re
-import json
-from string import Template
 from datetime import datetime, timezone
 
+from . import metrics
 from .constants import PROGRAM_NAME, PROGRAM_VERSION, GITHUB_URL
 from .open_project import OpenProjectURL
+from .highlight import KeywordHighlighter
+from .summary import SummaryAggregator
+from .templates import compile_json_template
+
+_POST_SECONDS = metrics.REGISTRY.histogram('dolphin_slack_post_seconds', "Duration of single Slack post attempts")
+_POST_ERRORS = metrics.REGISTRY.counter('dolphin_slack_post_errors_total', "Failed Slack post attempts")
+SLACK_RETRIES = metrics.REGISTRY.counter('dolphin_slack_retries_total', "Retried Slack posts")
+_RENDER_SINGLE_SECONDS = metrics.REGISTRY.histogram('dolphin_message_render_seconds', "Duration of building a message",
+                                                    labels={'message': 'single'})
+_RENDER_SUMMARIZED_SECONDS = metrics.REGISTRY.histogram('dolphin_message_render_seconds',
+                                                        "Duration of building a message",
+                                                        labels={'message': 'summarized'})
 
 
 class SlackConnection:
     """ Used for posting messages to Slack """
 
-    def __init__(self, url_hook, max_retries=5, wait_on_fail=5):
+    def __init__(self, url_hook, max_retries=5, wait_on_fail=5, transport=None):
         self.url_hook = url_hook
+        self._urlopen = transport.urlopen if transport is not None else urllib.request.urlopen
         self.max_retries = max_retries
         self.wait_on_fail = wait_on_fail
         logging.debug("Created a SlackConnection to %s.", self.url_hook)
@@ -26,29 +37,49 @@ class SlackConnection:
         while not is_sent and (self.max_retries is None or retries <= self.max_retries):
             if retries > 0:
                 logging.info("Retry #%i.", retries)
-            logging.debug('Message posting in progress. Connecting to Slack for POST request.')
-            request = urllib.request.Request(self.url_hook, headers={'Content-type': "application/json"})
+                SLACK_RETRIES.inc()
             try:
-                with urllib.request.urlopen(request, bytes(json_message, 'utf8')) as resp:
-                    resp = resp.read().decode('utf8')
-                    logging.debug("Response: %s.", resp.upper())
+                self.send(json_message)
                 is_sent = True
             except urllib.request.HTTPError as http_err:
                 logging.error("Error while executing HTTP request to Slack (Status: %i). "
                               "More info: %s", http_err.code, http_err)
                 retries += 1
-                time.sleep(self.wait_on_fail)
+                retry_after = self.retry_after(http_err)
+                time.sleep(retry_after if retry_after is not None else self.wait_on_fail)
             except urllib.request.URLError as url_err:
                 logging.error("Unable to connect to Slack. Probably not connected to the internet or wrong URL."
                               " More info: %s", url_err)
                 retries += 1
                 time.sleep(self.wait_on_fail)
 
+    def send(self, json_message):
+        """ Sends the message exactly once. Raises urllib's HTTPError or URLError if it fails. """
+        logging.debug('Message posting in progress. Connecting to Slack for POST request.')
+        request = urllib.request.Request(self.url_hook, headers={'Content-type': "application/json"})
+        try:
+            with _POST_SECONDS.time(), self._urlopen(request, bytes(json_message, 'utf8')) as resp:
+                resp = resp.read().decode('utf8')
+                logging.debug("Response: %s.", resp.upper())
+        except OSError:
+            _POST_ERRORS.inc()
+            raise
+
+    @staticmethod
+    def retry_after(http_err):
+        """ Returns the seconds to wait if Slack is rate limiting us (HTTP 429 with Retry-After), otherwise None """
+        if http_err.code != 429 or http_err.headers is None:
+            return None
+        try:
+            return max(0.0, float(http_err.headers.get('Retry-After')))
+        except (TypeError, ValueError):
+            return None
+
 
 class SlackMessageBuilder:
     """ Used to build formatted Slack messages for the bot in JSON format """
 
-    # Message with a single attachment ($vars need to be substituted by using build_json method)
+    # Message with a single attachment ($vars are substituted by the render function compiled in the constructor)
     SINGLE_MESSAGE = \
         {
             'username': PROGRAM_NAME,
@@ -93,7 +124,8 @@ class SlackMessageBuilder:
             }]
         }
 
-    # Maps the types to a tuple with emoji [0] and color [1] (will replace $type_emoji and $color)
+    # Maps the types to a tuple with emoji [0] and color [1] (will replace $type_emoji and $color).
+    # Types that are not listed here use the look of None.
     _TYPE_MAP = {
         None: (':coffee:', '00b7c3'),
         'work_packages': (':package:', '00b7c3'),
@@ -116,89 +148,98 @@ class SlackMessageBuilder:
         (lambda c: c >= 12 and random.randint(0, 1) == 1, "Huzzah! :heart_eyes:"),
         (lambda c: c >= 14 and 6 > datetime.now().hour >= 0, "Thank you night owl! :full_moon_with_face:")
     ]
+    # Plain keywords, highlighted as whole words only:
     _FORMAT_ITALIC = ('New', 'In progress', 'Closed', 'On hold', 'Permanent', 'Rejected',  # Status
                       'Task', 'Phase', 'Milestone', 'Release', 'Feature', 'Bug')           # Other keywords
-    _FORMAT_BOLD = ()  # '#[0-9]*' will print e.g. '#12' in bold
+    _FORMAT_BOLD = ()
+    # Regular expressions as (pattern, markup) tuples, e.g. (r'#[0-9]+', highlight.BOLD) will print '#12' in bold:
+    _FORMAT_PATTERNS = ()
+
+    def __init__(self, op_url_builder, max_titles_per_type=3, highlight_keywords=True, highlighter=None,
+                 clock=time.time):
+        """
+        Creates a SlackMessageBuilder.
 
-    def __init__(self, op_url_builder, max_titles_per_type=3, highlight_keywords=True):
+        :param op_url_builder: OpenProjectURL used for the links in the summarized message
+        :param max_titles_per_type: Number of listed titles per type in the summarized message
+        :param highlight_keywords: Enables keyword highlighting in titles
+        :param highlighter: Custom highlight.KeywordHighlighter, e.g. with user-configured keyword lists.
+                            Default: highlighter for _FORMAT_ITALIC, _FORMAT_BOLD and _FORMAT_PATTERNS.
+        :param clock: Wall clock function (seconds since the epoch) for the age of a summary
+        """
         self._max_titles_per_type = max_titles_per_type
         self.highlight_keywords = highlight_keywords
         self._op_url_builder = op_url_builder
+        self._clock = clock
+        self._highlighter = highlighter if highlighter is not None else \
+            KeywordHighlighter(self._FORMAT_ITALIC, self._FORMAT_BOLD, self._FORMAT_PATTERNS)
+
+        # The templates are compiled once, so changes to the message dictionaries have to happen before this point:
+        self._render_single = compile_json_template(self.SINGLE_MESSAGE)
+        self._render_attachment = compile_json_template(self.SUMMARIZED_MESSAGE['attachments'][0])
+        summarized_message = dict(self.SUMMARIZED_MESSAGE, attachments='$attachments')
+        self._render_summarized = compile_json_template(summarized_message, raw_fields=('attachments',))
 
     def build_single_message(self, entry):
-        return Template(json.dumps(self.SINGLE_MESSAGE)) \
-            .safe_substitute(type=OpenProjectURL.part_to_text(entry['type']),
-                             type_emoji=self._TYPE_MAP[entry['type']][0],
-                             color=self._TYPE_MAP[entry['type']][1],
-                             title_url=entry['url'],
-                             text=self._highlight_text(entry['title']),
-                             author=entry['author'],
-                             timestamp=entry['datetime'].timestamp())
-
-    def build_multi_part_message(self, entries, list_format="<{url}|➜> {title}\\n"):
-        if len(entries) < 1:
+        with _RENDER_SINGLE_SECONDS.time():
+            return self._build_single_message(entry)
+
+    def create_summary(self):
+        """ Returns an empty SummaryAggregator that collects entries for build_multi_part_message """
+        return SummaryAggregator(self._max_titles_per_type)
+
+    def build_multi_part_message(self, entries, list_format="<{url}|➜> {title}\n"):
+        """ Builds the summarized message of a list of entries or of a SummaryAggregator (see create_summary) """
+        with _RENDER_SUMMARIZED_SECONDS.time():
+            if not isinstance(entries, SummaryAggregator):
+                summary = self.create_summary()
+                summary.extend(entries)
+                entries = summary
+            return self._build_multi_part_message(entries, list_format)
+
+    def _build_single_message(self, entry):
+        return self._render_single(type=OpenProjectURL.part_to_text(entry.type),
+                                   type_emoji=self._type_style(entry.type)[0],
+                                   color=self._type_style(entry.type)[1],
+                                   title_url=entry.url,
+                                   text=self._highlight_text(entry.title),
+                                   author=entry.author,
+                                   timestamp=entry.datetime.timestamp())
+
+    def _build_multi_part_message(self, summary, list_format):
+        if len(summary) < 1:
             return
-        type_info = {}
-        first_entry_time = entries[0]['datetime']
-        for entry in entries:
-            if type_info.get(entry['type']) is None:
-                type_info[entry['type']] = {}
-                type_info[entry['type']]['count'] = 1
-                type_info[entry['type']]['authors'] = {}
-                type_info[entry['type']]['authors'][entry['author']] = 1
-                if type_info[entry['type']]['count'] <= self._max_titles_per_type:
-                    type_info[entry['type']]['attachment_text'] = \
-                        list_format.format(url=entry['url'], title=entry['title'])
-            else:
-                type_info[entry['type']]['count'] += 1
-                if type_info[entry['type']]['authors'].get(entry['author']) is None:
-                    type_info[entry['type']]['authors'][entry['author']] = 1
-                else:
-                    type_info[entry['type']]['authors'][entry['author']] += 1
-                if type_info[entry['type']]['count'] <= self._max_titles_per_type:
-                    type_info[entry['type']]['attachment_text'] += \
-                        list_format.format(url=entry['url'], title=entry['title'])
         attachments = []
-        for t in type_info:
-            authors_text = ""
-            authors = type_info[t]['authors']
-            for author in enumerate(authors):
-                author_changes = type_info[t]['authors'][author[1]]
-                if author[0] < (len(authors)-1):
-                    authors_text += '{0} ({1}%), '.format(author[1], int(100/len(entries)*author_changes))
-                else:
-                    authors_text += '{0} ({1}%).'.format(author[1], int(100/len(entries)*author_changes))
-            # BEGIN OF INEFFICIENCY
-            if type_info[t]['count'] > self._max_titles_per_type:
-                type_info[t]['attachment_text'] += " ..."
-            attachment_json = Template(json.dumps(self.SUMMARIZED_MESSAGE['attachments'][0])) \
-                .safe_substitute(type=OpenProjectURL.part_to_text(t),
-                                 type_counter=type_info[t]['count'],
-                                 type_emoji=self._TYPE_MAP[t][0],
-                                 color=self._TYPE_MAP[t][1],
-                                 text=self._highlight_text(type_info[t]['attachment_text']),
-                                 activities_filtered_url=self._op_url_builder.build_activity_url((t,)),
-                                 authors=authors_text)
-            attachments.append(json.loads(attachment_json))
-            # the message dict has been 1.) dumped/serialized to perform a substitution,
-            # then 2.) deserialized to append the - now substituted - attachment. Not a big problem, but worth a note.
-            # END OF INEFFICIENCY
-        message = self.SUMMARIZED_MESSAGE.copy()
-        message['attachments'] = attachments
+        for t, type_summary in summary.types.items():
+            authors_text = ', '.join('{0} ({1}%)'.format(author, int(100 / len(summary) * changes))
+                                     for author, changes in type_summary.authors.items()) + '.'
+            attachment_text = ''.join(list_format.format(url=url, title=title) for url, title in type_summary.links)
+            if type_summary.count > self._max_titles_per_type:
+                attachment_text += " ..."
+            filtered_url = self._op_url_builder.build_activity_url((t,))
+            attachments.append(self._render_attachment(type=OpenProjectURL.part_to_text(t),
+                                                       type_counter=type_summary.count,
+                                                       type_emoji=self._type_style(t)[0],
+                                                       color=self._type_style(t)[1],
+                                                       text=self._highlight_text(attachment_text),
+                                                       activities_filtered_url=filtered_url,
+                                                       authors=authors_text))
         praise = None
         for condition in enumerate(self._TEXT_PRAISE):
-            if condition[1][0](len(entries)):
+            if condition[1][0](len(summary)):
                 praise = condition[1][1]
-        time_diff = (datetime.now(timezone.utc).astimezone(tz=None) - first_entry_time)
-        return Template(json.dumps(message)).safe_substitute(changes=len(entries),
-                                                             pre_praise=praise,
-                                                             minutes=round(time_diff.seconds / 60, 1),
-                                                             base_url=self._op_url_builder.base_url)
+        time_diff = (datetime.fromtimestamp(self._clock(), timezone.utc) - summary.first_entry_time)
+        return self._render_summarized(attachments='[' + ', '.join(attachments) + ']',
+                                       changes=len(summary),
+                                       pre_praise=praise,
+                                       minutes=round(time_diff.seconds / 60, 1),
+                                       base_url=self._op_url_builder.base_url)
+
+    def _type_style(self, activity_type):
+        # Types of custom modules (see open_project.ActivityClassifier) fall back to the look of unknown types:
+        return self._TYPE_MAP.get(activity_type, self._TYPE_MAP[None])
 
     def _highlight_text(self, text):
         if self.highlight_keywords:
-            for kw in self._FORMAT_ITALIC:
-                text = re.sub(kw, '_\g<0>_', text)
-            for kw in self._FORMAT_BOLD:
-                text = re.sub(kw, '*\g<0>*', text)
+            return self._highlighter.highlight(text)
         return text
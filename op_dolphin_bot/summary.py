@@ -0,0 +1,142 @@
+import collections
+import time
+from urllib.parse import urldefrag
+
+from .checkpoint import encode_time, decode_time
+
+
+class SummaryAggregator:
+    """ Aggregates entries for the smart summary as they arrive, in memory O(types + authors)
+
+    Instead of the entries, only what the summarized message shows is kept: the count and the author tallies per type
+    and the first `max_titles_per_type` links of every type. Adding an entry and building the message therefore cost
+    the same, no matter how long the feed stays busy.
+    """
+
+    def __init__(self, max_titles_per_type=3):
+        self.max_titles_per_type = max_titles_per_type
+        self.count = 0
+        self.first_entry_time = None
+        # type -> _TypeSummary, in order of appearance:
+        self.types = collections.OrderedDict()
+
+    def add(self, entry):
+        self.count += 1
+        if self.first_entry_time is None:
+            self.first_entry_time = entry.datetime
+        type_summary = self.types.get(entry.type)
+        if type_summary is None:
+            type_summary = self.types[entry.type] = _TypeSummary()
+        type_summary.count += 1
+        type_summary.authors[entry.author] = type_summary.authors.get(entry.author, 0) + 1
+        if len(type_summary.links) < self.max_titles_per_type:
+            type_summary.links.append((entry.url, entry.title))
+
+    def extend(self, entries):
+        """ Adds entries, which may be another SummaryAggregator (e.g. to merge two summaries) """
+        if not isinstance(entries, SummaryAggregator):
+            for entry in entries:
+                self.add(entry)
+            return
+        self.count += entries.count
+        if self.first_entry_time is None:
+            self.first_entry_time = entries.first_entry_time
+        for activity_type, other in entries.types.items():
+            type_summary = self.types.get(activity_type)
+            if type_summary is None:
+                type_summary = self.types[activity_type] = _TypeSummary()
+            type_summary.count += other.count
+            for author, changes in other.authors.items():
+                type_summary.authors[author] = type_summary.authors.get(author, 0) + changes
+            type_summary.links.extend(other.links[:self.max_titles_per_type - len(type_summary.links)])
+
+    def __len__(self):
+        return self.count
+
+    def to_state(self):
+        """ JSON serializable state (see checkpoint.Checkpoint) """
+        return {'count': self.count, 'first_entry_time': encode_time(self.first_entry_time),
+                'types': [[t, s.count, list(s.authors.items()), s.links] for t, s in self.types.items()]}
+
+    @classmethod
+    def from_state(cls, state, max_titles_per_type=3):
+        summary = cls(max_titles_per_type)
+        summary.count = state['count']
+        summary.first_entry_time = decode_time(state['first_entry_time'])
+        for activity_type, count, authors, links in state['types']:
+            type_summary = summary.types[activity_type] = _TypeSummary()
+            type_summary.count = count
+            type_summary.authors.update((author, changes) for author, changes in authors)
+            type_summary.links = [tuple(link) for link in links[:max_titles_per_type]]
+        return summary
+
+
+class _TypeSummary:
+    __slots__ = ('count', 'authors', 'links')
+
+    def __init__(self):
+        self.count = 0
+        # author -> changes, in order of appearance:
+        self.authors = collections.OrderedDict()
+        # (url, title) of the first entries:
+        self.links = []
+
+
+class DedupIndex:
+    """ Remembers recently seen entries to detect repetitions, bounded in size (LRU) and time (window)
+
+    Entries are keyed on (title, author, url). The fragment of the URL is ignored: OpenProject links every change of
+    a work package with another "#activity-N", but the same title by the same author on the same page is a repetition.
+    """
+
+    def __init__(self, max_size=4096, window=600, clock=time.monotonic):
+        """
+        :param max_size: Maximum number of remembered entries (the least recently seen ones are forgotten first)
+        :param window: Forgets entries that have not been seen for N seconds
+        :param clock: Monotonic clock function
+        """
+        self.max_size = max_size
+        self.window = window
+        self._clock = clock
+        # key -> time last seen, least recently seen first:
+        self._seen = collections.OrderedDict()
+
+    @staticmethod
+    def key(entry):
+        return entry.title, entry.author, urldefrag(entry.url)[0] if entry.url else entry.url
+
+    def seen(self, entry):
+        """ Returns True if the entry repeats an entry seen within the window, and remembers it either way """
+        now = self._clock()
+        self._expire(now)
+        key = self.key(entry)
+        repeated = key in self._seen
+        if repeated:
+            self._seen.move_to_end(key)
+        self._seen[key] = now
+        if len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+        return repeated
+
+    def _expire(self, now):
+        while self._seen:
+            key, last_seen = next(iter(self._seen.items()))
+            if now - last_seen < self.window:
+                break
+            del self._seen[key]
+
+    def __len__(self):
+        return len(self._seen)
+
+    def to_state(self):
+        """ JSON serializable state with the age of the entries (the clock is not persistent) """
+        now = self._clock()
+        return [list(key) + [now - last_seen] for key, last_seen in self._seen.items()]
+
+    def restore(self, state):
+        now = self._clock()
+        for title, author, url, age in state:
+            self._seen[(title, author, url)] = now - age
+        self._expire(now)
+        while len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
@@ -0,0 +1,64 @@
+import json
+import re
+from json.encoder import encode_basestring_ascii
+
+# Same placeholder syntax as string.Template: $name, ${name} and $$ (escaped dollar sign)
+_PLACEHOLDER = re.compile(r'\$(?:(?P<escaped>\$)|(?P<named>[_a-z][_a-z0-9]*)|{(?P<braced>[_a-z][_a-z0-9]*)})',
+                          re.IGNORECASE)
+
+
+def compile_json_template(template, raw_fields=()):
+    """ Compiles a message template (dict with $placeholders in its strings) into a reusable render function.
+
+    The template is serialized and split into literal chunks and placeholders only once. The render function then
+    builds the JSON payload in a single pass: values are JSON-escaped, so quotes or backslashes in a title can not
+    break the payload. Like string.Template.safe_substitute, placeholders without a value are kept as they are.
+
+    :param template: JSON-serializable dict, e.g. SlackMessageBuilder.SINGLE_MESSAGE
+    :param raw_fields: Names of placeholders which fill a whole JSON value (written as "$name") with already
+                       serialized JSON, e.g. a list of rendered attachments. Their values are inserted unescaped.
+    :return: Function render(**values) returning the JSON payload as str
+    """
+    source = json.dumps(template)
+    literals = ['']
+    placeholders = []
+    position = 0
+    for match in _PLACEHOLDER.finditer(source):
+        start, end = match.span()
+        name = match.group('named') or match.group('braced')
+        if name is None:
+            literals[-1] += source[position:start] + '$'
+        else:
+            raw = name in raw_fields
+            if raw:
+                # The placeholder replaces the whole string value including its quotes:
+                if source[start - 1:start] != '"' or source[end:end + 1] != '"':
+                    raise ValueError("Raw placeholder ${0} has to be the only content of a string.".format(name))
+                start -= 1
+                end += 1
+            literals[-1] += source[position:start]
+            # (name, insert unescaped?, text kept if there is no value)
+            placeholders.append((name, raw, source[start:end]))
+            literals.append('')
+        position = end
+    literals[-1] += source[position:]
+    return _build_renderer(literals[0], list(zip(placeholders, literals[1:])))
+
+
+def _build_renderer(head, parts):
+    def render(**values):
+        out = [head]
+        for (name, raw, fallback), literal in parts:
+            value = values.get(name, _MISSING)
+            if value is _MISSING:
+                out.append(fallback)
+            elif raw:
+                out.append(value)
+            else:
+                out.append(encode_basestring_ascii(str(value))[1:-1])
+            out.append(literal)
+        return ''.join(out)
+    return render
+
+
+_MISSING = object()
@@ -0,0 +1,273 @@
+import hashlib
+import hmac
+import json
+import logging
+import re
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler
+
+from . import metrics
+from .activity import Activity, parse_rfc3339
+from .api import link_title, work_package_title
+
+_WEBHOOK_REQUESTS = {status: metrics.REGISTRY.counter('dolphin_webhook_requests_total', "Received webhook requests",
+                                                      {'result': status})
+                     for status in ('accepted', 'ignored', 'invalid_signature', 'invalid_payload', 'too_large')}
+
+_ISO_DURATION = re.compile(r'^P(?:(\d+(?:\.\d+)?)D)?(?:T(?:(\d+(?:\.\d+)?)H)?(?:(\d+(?:\.\d+)?)M)?'
+                           r'(?:(\d+(?:\.\d+)?)S)?)?$')
+
+
+class OpenProjectWebhookReceiver:
+    """ Embedded HTTP server that receives the outgoing webhooks of OpenProject (Administration -> Webhooks)
+
+    Payloads are turned into the same Activity objects the Atom feed reader delivers and are queued in the inbox of
+    the subscribed project (see subscribe). Only the types in COVERED_FILTERS are sent by OpenProject, everything else
+    (wiki, news, ...) still has to be polled from the Atom feed.
+    """
+
+    COVERED_FILTERS = ('work_packages', 'time_entries')
+    SIGNATURE_HEADER = 'X-OP-Signature'
+
+    def __init__(self, op_base_url, secret=None, port=8090, host='0.0.0.0', path='/op-webhook', settle=0.5,
+                 api=None, max_body=1024 * 1024):
+        """
+        Creates an OpenProjectWebhookReceiver. Call start() to serve the webhooks in the background.
+
+        :param op_base_url: Base URL for OpenProject, used to build the links of the entries
+        :param secret: Secret of the webhook in OpenProject. Requests without a valid signature are rejected.
+                       None accepts unsigned requests (only for trusted networks!).
+        :param port: Port to listen on (0 picks a free port, see `port`)
+        :param host: Interface to listen on
+        :param path: Path of the webhook URL as configured in OpenProject (http://HOST:PORT/PATH)
+        :param settle: Seconds a woken up bot waits for further webhooks of the same burst (e.g. a bulk edit),
+                       so that the smart summary sees the whole burst at once
+        :param api: Optional api.OpenProjectAPI. Work package payloads only name the creator of the work package,
+                    with the API, the user who made the change is looked up in the activities of the work package.
+                    Without, pushed updates are credited to the creator (see PushedActivity).
+        :param max_body: Larger requests are rejected (HTTP 413) without reading them, before the signature is checked
+        """
+        self.op_base_url = op_base_url.rstrip('/')
+        self.path = path
+        self.settle = settle
+        self.max_body = max_body
+        self._api = api
+        self._secret = secret.encode('utf8') if secret is not None else None
+        self._inboxes = {}
+        self._lock = threading.Lock()
+        self._server = metrics.ThreadingHTTPServer((host, port), _WebhookHandler)
+        self._server.receiver = self
+        self.port = self._server.server_address[1]
+        self._thread = None
+        if secret is None:
+            logging.warning("Webhook receiver accepts unsigned requests. Configure a secret in OpenProject!")
+
+    def subscribe(self, project_id):
+        """ Returns the WebhookInbox that collects the entries of the given project (numeric ID or identifier) """
+        with self._lock:
+            inbox = self._inboxes.get(str(project_id))
+            if inbox is None:
+                inbox = self._inboxes[str(project_id)] = WebhookInbox(self.settle)
+            return inbox
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="WebhookReceiver", daemon=True)
+        self._thread.start()
+        logging.info("Receiving OpenProject webhooks on port %i (path %s).", self.port, self.path)
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def handle(self, body, signature=None):
+        """
+        Validates and processes one webhook request.
+
+        :param body: Raw request body (bytes)
+        :param signature: Value of the X-OP-Signature header ("sha1=<hex digest>")
+        :return: HTTP status for the response
+        """
+        if not self.is_signature_valid(body, signature):
+            logging.warning("Rejected webhook request with an invalid signature.")
+            _WEBHOOK_REQUESTS['invalid_signature'].inc()
+            return 401
+        try:
+            payload = json.loads(body.decode('utf8'))
+            projects, entry = self.build_entry(payload, self.op_base_url)
+        except (ValueError, KeyError, TypeError, AttributeError) as err:
+            logging.warning("Unable to process webhook payload. More info: %s", err)
+            _WEBHOOK_REQUESTS['invalid_payload'].inc()
+            return 400
+        if entry is not None and not entry.author_known and self._api is not None:
+            entry = self._resolve_author(entry, payload['work_package']['id'])
+        with self._lock:
+            inboxes = {id(inbox): inbox for inbox in (self._inboxes.get(p) for p in projects) if inbox is not None}
+        if entry is None or not inboxes:
+            _WEBHOOK_REQUESTS['ignored'].inc()
+            return 200
+        for inbox in inboxes.values():
+            inbox.put(entry)
+        _WEBHOOK_REQUESTS['accepted'].inc()
+        return 200
+
+    def is_signature_valid(self, body, signature):
+        if self._secret is None:
+            return True
+        if not signature or not signature.startswith('sha1='):
+            return False
+        expected = hmac.new(self._secret, body, hashlib.sha1).hexdigest()
+        return hmac.compare_digest(expected, signature[len('sha1='):].strip())
+
+    def _resolve_author(self, entry, work_package_id):
+        """ Returns the entry with the user (and the link) of the latest activity of the work package """
+        try:
+            activities = self._api.get('/api/v3/work_packages/{0}/activities'.format(work_package_id))
+            latest = activities['_embedded']['elements'][-1]
+            author = link_title(latest['_links'], 'user', None)
+        except (urllib.request.URLError, OSError, ValueError, KeyError, IndexError) as err:
+            logging.warning("Unable to look up the author of a change of work package %s. More info: %s",
+                            work_package_id, err)
+            return entry
+        if author is None:
+            return entry
+        # Same link as the Atom feed and the backfill (see api.ActivityBackfill):
+        url = "{0}/work_packages/{1}#activity-{2}".format(self.op_base_url, work_package_id,
+                                                          latest.get('version', latest.get('id')))
+        return PushedActivity(entry.title, url, entry.datetime, author, entry.type)
+
+    @staticmethod
+    def build_entry(payload, op_base_url):
+        """
+        Turns a webhook payload into an Activity like OpenProjectActivities._build_entry.
+
+        :return: (project keys, entry). The project keys are the ID and identifier of the project (as strings).
+                 The entry is None for actions that are not notified (e.g. project or attachment events).
+        """
+        action = payload['action']
+        author_known = True
+        if action.startswith('work_package:'):
+            resource = payload['work_package']
+            title = work_package_title(resource)
+            url = "{0}/work_packages/{1}".format(op_base_url, resource['id'])
+            # The payload only names the creator, who made the change is only known for a new work package:
+            author = link_title(resource['_links'], 'author', None)
+            author_known = action == 'work_package:created'
+            activity_type = 'work_packages'
+        elif action.startswith('time_entry:'):
+            resource = payload['time_entry']
+            links = resource['_links']
+            title = "{0} ({1})".format(_format_hours(resource.get('hours')),
+                                       link_title(links, 'workPackage', link_title(links, 'project', "-")))
+            url = "{0}/time_entries/{1}".format(op_base_url, resource['id'])
+            author = link_title(links, 'user', None)
+            activity_type = 'time_entries'
+        else:
+            return (), None
+        updated = resource.get('updatedAt') or resource['createdAt']
+        return _project_keys(resource), PushedActivity(title, url, parse_rfc3339(updated), author, activity_type,
+                                                       author_known)
+
+
+class PushedActivity(Activity):
+    """ Activity of a webhook. `author_known` is False if the author is the creator of the work package, not
+    necessarily the user who made the change. Such entries can not be told apart from repetitions (see DolphinBot).
+    """
+
+    __slots__ = ('author_known',)
+
+    def __init__(self, title, url, datetime, author, type, author_known=True):
+        super().__init__(title, url, datetime, author, type)
+        self.author_known = author_known
+
+
+class WebhookInbox:
+    """ Thread-safe queue of pushed entries for one project, drained by the bot """
+
+    def __init__(self, settle=0.0):
+        self.settle = settle
+        self._entries = []
+        self._lock = threading.Lock()
+        self._arrived = threading.Event()
+        self._listeners = []
+
+    def put(self, entry):
+        with self._lock:
+            self._entries.append(entry)
+            self._arrived.set()
+        for listener in self._listeners:
+            listener()
+
+    def add_listener(self, listener):
+        """ Calls `listener()` whenever an entry arrives (in the receiver's thread), e.g. to wake up a coroutine """
+        self._listeners.append(listener)
+
+    def drain(self):
+        """ Returns and removes all queued entries (oldest first) """
+        with self._lock:
+            entries, self._entries = self._entries, []
+            self._arrived.clear()
+            return entries
+
+    def wait(self, timeout=None):
+        """ Sleeps until entries arrive or the timeout passes (usable as `sleep` of AdaptivePollScheduler.wait) """
+        if not self._arrived.wait(timeout):
+            return False
+        if self.settle:
+            time.sleep(self.settle)
+        return True
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+def _project_keys(resource):
+    keys = set()
+    project = resource.get('_embedded', {}).get('project')
+    if project:
+        keys.update(str(project[key]) for key in ('id', 'identifier') if project.get(key) is not None)
+    href = (resource['_links'].get('project') or {}).get('href')
+    if href:
+        keys.add(href.rstrip('/').rpartition('/')[2])
+    return keys
+
+
+def _format_hours(duration):
+    """ "PT1H30M" -> "1.50 hours" """
+    match = _ISO_DURATION.match(duration or '')
+    if match is None:
+        return duration or "Time entry"
+    days, hours, minutes, seconds = (float(part) if part else 0.0 for part in match.groups())
+    return "{0:.2f} hours".format(days * 24 + hours + minutes / 60 + seconds / 3600)
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        receiver = self.server.receiver
+        if self.path.split('?', 1)[0] != receiver.path:
+            self._respond(404)
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if not 0 <= length <= receiver.max_body:
+            # The length is up to the client, so the body is neither read nor hashed (and the connection not reused):
+            logging.warning("Rejected webhook request with a Content-Length of %s.", self.headers.get('Content-Length'))
+            _WEBHOOK_REQUESTS['too_large' if length > 0 else 'invalid_payload'].inc()
+            self.close_connection = True
+            self._respond(413 if length > 0 else 400)
+            return
+        body = self.rfile.read(length)
+        self._respond(receiver.handle(body, self.headers.get(receiver.SIGNATURE_HEADER)))
+
+    def _respond(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
@@ -0,0 +1,64 @@
+""" Highlight-Benchmark
+
+Compares the old keyword highlighting (one re.sub per keyword) with the compiled KeywordHighlighter for growing
+keyword sets. "cold" renders unique titles only, "warm" repeats titles and therefore hits the memoization.
+
+Usage (from the repository root): python -m util.bench_highlight
+"""
+
+import random
+import re
+import timeit
+
+from op_dolphin_bot.highlight import KeywordHighlighter, BOLD
+
+ROUNDS = 3
+STATUSES = ('New', 'In progress', 'Closed', 'On hold', 'Permanent', 'Rejected', 'Resolved', 'Feedback')
+TYPES = ('Task', 'Phase', 'Milestone', 'Release', 'Feature', 'Bug', 'Epic', 'User story')
+
+
+def legacy_highlight(text, italic, bold):
+    for kw in italic:
+        text = re.sub(kw, '_\\g<0>_', text)
+    for kw in bold:
+        text = re.sub(kw, '*\\g<0>*', text)
+    return text
+
+
+def make_keywords(count):
+    keywords = list(STATUSES + TYPES)
+    keywords += ['Component{0}'.format(i) for i in range(count - len(keywords))]
+    return keywords[:count]
+
+
+def make_titles(count, keywords, words=12):
+    rnd = random.Random(42)
+    vocabulary = ['dolphin', 'swims', 'faster', 'than', 'the', 'shark', 'renewal', 'fix'] + keywords
+    return ["#{0} {1}".format(i, ' '.join(rnd.choice(vocabulary) for _ in range(words))) for i in range(count)]
+
+
+def main():
+    print("{0:>9} {1:>14} {2:>14} {3:>14}".format("keywords", "legacy/s", "cold/s", "warm/s"))
+    for count in (16, 64, 256, 1024):
+        keywords = make_keywords(count)
+        italic, bold = keywords[::2], keywords[1::2]
+        titles = make_titles(200, keywords)
+        repeated = titles[:20] * 10
+
+        legacy = min(timeit.repeat(lambda: [legacy_highlight(t, italic, bold + [r'#[0-9]+']) for t in titles],
+                                   number=1, repeat=ROUNDS))
+
+        def cold():
+            highlighter = KeywordHighlighter(italic, bold, [(r'#[0-9]+', BOLD)])
+            for t in titles:
+                highlighter.highlight(t)
+
+        highlighter = KeywordHighlighter(italic, bold, [(r'#[0-9]+', BOLD)])
+        compiled = min(timeit.repeat(cold, number=1, repeat=ROUNDS))
+        warm = min(timeit.repeat(lambda: [highlighter.highlight(t) for t in repeated], number=1, repeat=ROUNDS))
+        print("{0:>9} {1:>14.0f} {2:>14.0f} {3:>14.0f}"
+              .format(count, len(titles) / legacy, len(titles) / compiled, len(repeated) / warm))
+
+
+if __name__ == '__main__':
+    main()
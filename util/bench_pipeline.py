@@ -0,0 +1,287 @@
+""" Pipeline-Benchmark
+
+End-to-end benchmark that runs completely offline against the local stand-ins (see util/stand_ins.py):
+
+1. Feed polling: one OpenProjectActivities polls as fast as possible (idle feed and busy feed).
+   Reports polls/sec and entries/sec.
+2. Bots: N DolphinBots (one project each) run for a while and post via the Slack stand-in.
+   Reports polls/sec, entries/sec, notification latency percentiles (entry appeared in feed -> Slack received
+   the message, including the smart summary delay) and memory.
+
+With --check it verifies the delivery instead of measuring it:
+
+- Backfill: a burst with shared (whole second) timestamps overflows the feed between the polls, so the
+  api.ActivityBackfill has to recover the gaps. Every work package change has to be delivered exactly once.
+- Webhooks: the WebhookSender posts work package events with valid, invalid and missing signatures (and one that
+  is too large) to a webhook.OpenProjectWebhookReceiver. Only the valid ones may arrive, mapped to the expected
+  entries.
+- Discovery: the ProjectDiscovery runs with and without the project collection. The ID scan has to find every
+  project and stop after max_misses consecutive missing IDs, and an unknown identifier must not be discovered twice.
+
+Usage (from the repository root): python -m util.bench_pipeline --help
+"""
+
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+
+from op_dolphin_bot.api import ActivityBackfill, OpenProjectAPI
+from op_dolphin_bot.discovery import ProjectDiscovery
+from op_dolphin_bot.dolphin_bot import DolphinBot
+from op_dolphin_bot.open_project import OpenProjectActivities, OpenProjectURL
+from op_dolphin_bot.transport import HTTPTransport
+from op_dolphin_bot.webhook import OpenProjectWebhookReceiver
+from util.stand_ins import ATOM_TYPES, OpenProjectStandIn, SlackStandIn, WebhookSender, TITLE_REFERENCE, \
+    work_package_resource
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def bench_polling(feed_size, duration):
+    results = {}
+    for name, churn in (('idle', 0.0), ('busy', 1000.0)):
+        op = OpenProjectStandIn(feed_size=feed_size, churn=churn).start()
+        activities = OpenProjectActivities(OpenProjectURL(op.url, 1).build_activity_atom_url('key'),
+                                           transport=HTTPTransport())
+        polls = entries = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < duration:
+            entries += len(activities.deliver_updates())
+            polls += 1
+        elapsed = time.perf_counter() - start
+        results[name] = {'polls_per_sec': polls / elapsed, 'entries_per_sec': entries / elapsed,
+                         'bytes_per_poll': activities.stats['bytes_received'] / activities.stats['fetches']}
+        op.stop()
+    return results
+
+
+def bench_bots(projects, feed_size, churn, duration, refresh_rate, slack_options):
+    op = OpenProjectStandIn(feed_size=feed_size, churn=churn).start()
+    slack = SlackStandIn(**slack_options).start()
+    transport = HTTPTransport(pool_size=projects)
+    bots = [DolphinBot("{0}/hook/{1}".format(slack.url, p), op.url, p, 'key', refresh_rate=refresh_rate,
+                       transport=transport) for p in range(projects)]
+    start = time.time()
+    for bot in bots:
+        threading.Thread(target=bot.run, daemon=True).start()
+    time.sleep(duration)
+    elapsed = time.time() - start
+
+    latencies = []
+    for received, _, payload in list(slack.payloads):
+        for project, seq in set(TITLE_REFERENCE.findall(json.dumps(payload))):
+            latencies.append(received - op.entry_time(int(project), int(seq)))
+    latencies.sort()
+    fetches = sum(bot._op_activities.stats['fetches'] for bot in bots)
+    entries = sum(bot._op_activities.stats['parsed_entries'] for bot in bots)
+    return {
+        'polls_per_sec': fetches / elapsed,
+        'entries_per_sec': entries / elapsed,
+        'messages': len(slack.payloads),
+        'notified_entries': len(latencies),
+        'latency_p50': _percentile(latencies, 50),
+        'latency_p90': _percentile(latencies, 90),
+        'latency_p99': _percentile(latencies, 99),
+        'latency_max': latencies[-1] if latencies else None,
+        'slack': dict(slack.stats),
+        'transport': dict(transport.stats),
+    }
+
+
+def check_backfill(duration, churn=20.0, feed_size=10, poll_intervals=(0.2, 1.0)):
+    """ Polls a bursty feed alternately fast and too slow (gaps), returns the changes that were missed or
+    delivered more than once """
+    project = 1
+    op = OpenProjectStandIn(feed_size=feed_size, churn=churn, time_resolution=1).start()
+    transport = HTTPTransport()
+    activities = OpenProjectActivities(OpenProjectURL(op.url, project).build_activity_atom_url('key'),
+                                       transport=transport,
+                                       backfill=ActivityBackfill(OpenProjectAPI(op.url, transport=transport), project))
+    first = op.served_counts[project]
+    delivered = Counter()
+    start = time.perf_counter()
+    polls = 0
+    while time.perf_counter() - start < duration:
+        time.sleep(poll_intervals[polls % len(poll_intervals)])
+        delivered.update(entry.change_key() for entry in activities.deliver_updates()
+                         if entry.type == 'work_packages')
+        polls += 1
+    op.stop()
+
+    # The stand-in's work packages have a single activity (version 1), see OpenProjectStandIn.handle_api:
+    def changes(end):
+        return {(project * 1000000 + seq, 1) for seq in range(first, end)
+                if ATOM_TYPES[seq % len(ATOM_TYPES)] == 'work_packages'}
+    expected = changes(op.served_counts[project])
+    # A backfill may already return changes of the same second that the last fetched feed did not have yet:
+    possible = changes(op.entry_count(project))
+    return {
+        'changes': len(expected),
+        'gaps': activities.stats['gaps'],
+        'backfilled_entries': activities.stats['backfilled_entries'],
+        'missing': sorted(expected - set(delivered)),
+        'duplicates': sorted(key for key, count in delivered.items() if count > 1),
+        'unexpected': sorted(set(delivered) - possible),
+    }
+
+
+def check_webhooks(secret='dolphin', max_body=16 * 1024):
+    """ Sends signed, wrongly signed and unsigned events to a receiver, returns the problems found """
+    op = OpenProjectStandIn(churn=0.0).start()
+    receiver = OpenProjectWebhookReceiver(op.url, secret=secret, port=0, host='127.0.0.1', settle=0,
+                                          api=OpenProjectAPI(op.url), max_body=max_body).start()
+    inbox = receiver.subscribe(1)
+    sender = WebhookSender("http://127.0.0.1:{0}{1}".format(receiver.port, receiver.path), secret)
+    updated = 1500000000.5
+    # The receiver looks the author of an update up in the activities of the stand-in's work package #1-0:
+    expected_entries = {
+        "{0}/work_packages/1000005".format(op.url): ("Flipper", 1000005),
+        "{0}/work_packages/1000000#activity-1".format(op.url): ("Jane Doe", 1000000),
+    }
+    unsigned = {'action': 'work_package:created', 'work_package': work_package_resource(1, 7, "Mallory", updated)}
+    too_large = {'action': 'work_package:created', 'work_package': work_package_resource(1, 8, "Flipper", updated),
+                 'padding': 'x' * max_body}
+    statuses = [
+        ('valid', sender.send_work_package(1, 5, 'work_package:created', "Flipper", updated), 200),
+        ('valid update', sender.send_work_package(1, 0, 'work_package:updated', "Creator", updated), 200),
+        ('other project', sender.send_work_package(2, 5, 'work_package:created', "Flipper", updated), 200),
+        ('invalid signature', sender.send(unsigned, signature='sha1=' + '0' * 40), 401),
+        ('missing signature', sender.send(unsigned, sign=False), 401),
+        ('signed with another secret', WebhookSender(sender.webhook_url, 'guess').send(unsigned), 401),
+        ('too large', sender.send(too_large), 413),
+    ]
+    entries = inbox.drain()
+    receiver.stop()
+    op.stop()
+
+    problems = ["{0}: HTTP {1} instead of {2}".format(name, status, expected)
+                for name, status, expected in statuses if status != expected]
+    if len(entries) != len(expected_entries):
+        problems.append("{0} entries arrived instead of {1}".format(len(entries), len(expected_entries)))
+    for entry in entries:
+        author, wp_id = expected_entries.get(entry.url, (None, None))
+        actual = (entry.author, entry.type, entry.author_known, entry.datetime.timestamp())
+        if actual != (author, 'work_packages', True, updated) or "#{0} (".format(wp_id) not in entry.title:
+            problems.append("Unexpected entry: {0!r}".format(entry))
+    return {'requests': len(statuses), 'problems': problems}
+
+
+def check_discovery(project_ids=(1, 2, 3, 7, 30, 31, 60, 85), max_misses=30, concurrency=8):
+    """ Discovers the projects via the collection and via the ID scan, returns the problems found """
+    problems = []
+    for collection in (True, False):
+        mode = "collection" if collection else "ID scan"
+        op = OpenProjectStandIn(churn=0.0, project_ids=project_ids, project_collection=collection).start()
+        discovery = ProjectDiscovery.create(op.url, None, concurrency=concurrency, max_misses=max_misses)
+        found = [project['id'] for project in discovery.projects()]
+        requests = op.stats['api_requests']
+        try:
+            discovery.resolve('unknown-project')
+            problems.append("{0}: an unknown identifier was resolved".format(mode))
+        except KeyError:
+            pass
+        repeated = op.stats['api_requests'] - requests
+        op.stop()
+
+        if found != sorted(project_ids):
+            problems.append("{0}: found the projects {1}".format(mode, found))
+        if not collection:
+            # The IDs up to the last miss are needed (plus the request for the collection), one batch of concurrent
+            # requests may overshoot:
+            needed = max(project_ids) + max_misses + 1
+            if not needed <= requests < needed + concurrency:
+                problems.append("{0}: {1} requests instead of {2} to {3}".format(mode, requests, needed,
+                                                                                needed + concurrency - 1))
+        if repeated:
+            problems.append("{0}: resolving an unknown identifier discovered again ({1} requests)"
+                            .format(mode, repeated))
+    return {'projects': len(project_ids), 'problems': problems}
+
+
+def run_checks(duration):
+    backfill = check_backfill(min(duration, 5))
+    print("Backfill: {0} work package changes, {1} gaps, {2} backfilled, {3} missing, {4} duplicates, "
+          "{5} unexpected".format(backfill['changes'], backfill['gaps'], backfill['backfilled_entries'],
+                                  len(backfill['missing']), len(backfill['duplicates']), len(backfill['unexpected'])))
+    webhooks = check_webhooks()
+    print("Webhooks: {0} requests, {1} problems".format(webhooks['requests'], len(webhooks['problems'])))
+    for problem in webhooks['problems']:
+        print("  " + problem)
+    discovery = check_discovery()
+    print("Discovery: {0} projects, {1} problems".format(discovery['projects'], len(discovery['problems'])))
+    for problem in discovery['problems']:
+        print("  " + problem)
+    return bool(backfill['gaps']) and not (backfill['missing'] or backfill['duplicates'] or backfill['unexpected']
+                                           or webhooks['problems'] or discovery['problems'])
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))]
+
+
+def _max_rss_mib():
+    if resource is None:
+        return None
+    # Linux reports KiB, macOS bytes:
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 1024 if max_rss < 1 << 30 else max_rss / (1 << 20)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the OP Dolphin Bot")
+    parser.add_argument('--projects', type=int, default=20, help="Number of watched projects (one bot each)")
+    parser.add_argument('--feed-size', type=int, default=50, help="Entries per Atom feed")
+    parser.add_argument('--churn', type=float, default=0.2, help="New entries per second and project")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds per benchmark")
+    parser.add_argument('--refresh-rate', type=float, default=1, help="refresh_rate of the bots in seconds")
+    parser.add_argument('--slack-latency', type=float, default=0.05, help="Seconds until Slack answers")
+    parser.add_argument('--slack-errors', type=float, default=0.0, help="Probability of HTTP 500 from Slack")
+    parser.add_argument('--slack-429', type=float, default=0.0, help="Probability of HTTP 429 from Slack")
+    parser.add_argument('--json', action='store_true', help="Print the results as JSON (e.g. to compare runs)")
+    parser.add_argument('--check', action='store_true',
+                        help="Verify that every change is delivered exactly once instead of benchmarking")
+    parser.add_argument('--verbose', action='store_true', help="Show the log of the bots")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(levelname)s: %(message)s',
+                        level=logging.INFO if args.verbose else logging.CRITICAL)
+    if args.check:
+        sys.exit(0 if run_checks(args.duration) else 1)
+
+    results = {
+        'polling': bench_polling(args.feed_size, min(args.duration, 5)),
+        'bots': bench_bots(args.projects, args.feed_size, args.churn, args.duration, args.refresh_rate,
+                           {'latency': args.slack_latency, 'error_rate': args.slack_errors,
+                            'rate_limit_rate': args.slack_429, 'seed': 42}),
+        'max_rss_mib': _max_rss_mib(),
+    }
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+
+    for name, result in sorted(results['polling'].items()):
+        print("Polling ({0} feed): {1:>8.1f} polls/s, {2:>9.1f} entries/s, {3:>8.0f} bytes/poll"
+              .format(name, result['polls_per_sec'], result['entries_per_sec'], result['bytes_per_poll']))
+    bots = results['bots']
+    print("Bots ({0} projects): {1:.1f} polls/s, {2:.1f} entries/s, {3} messages for {4} entries"
+          .format(args.projects, bots['polls_per_sec'], bots['entries_per_sec'], bots['messages'],
+                  bots['notified_entries']))
+    if bots['notified_entries']:
+        print("Notification latency: p50 {0:.2f}s, p90 {1:.2f}s, p99 {2:.2f}s, max {3:.2f}s"
+              .format(bots['latency_p50'], bots['latency_p90'], bots['latency_p99'], bots['latency_max']))
+    print("Slack stand-in: {0}".format(bots['slack']))
+    print("HTTP transport: {0}".format(bots['transport']))
+    if results['max_rss_mib'] is not None:
+        print("Peak memory (max RSS): {0:.1f} MiB".format(results['max_rss_mib']))
+
+
+if __name__ == '__main__':
+    main()
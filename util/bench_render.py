@@ -0,0 +1,86 @@
+""" Render-Benchmark
+
+Microbenchmark for SlackMessageBuilder: compares the old json.dumps/string.Template/json.loads round-trips
+("before") with the precompiled render functions ("after") in messages rendered per second.
+
+Usage (from the repository root): python -m util.bench_render
+"""
+
+import json
+import timeit
+from datetime import datetime, timezone
+from string import Template
+
+from op_dolphin_bot.activity import Activity
+from op_dolphin_bot.open_project import OpenProjectURL
+from op_dolphin_bot.slack import SlackMessageBuilder
+
+ROUNDS = 5
+
+
+def legacy_single_message(builder, entry):
+    return Template(json.dumps(builder.SINGLE_MESSAGE)) \
+        .safe_substitute(type=OpenProjectURL.part_to_text(entry.type),
+                         type_emoji=builder._TYPE_MAP[entry.type][0],
+                         color=builder._TYPE_MAP[entry.type][1],
+                         title_url=entry.url,
+                         text=builder._highlight_text(entry.title),
+                         author=entry.author,
+                         timestamp=entry.datetime.timestamp())
+
+
+def legacy_attachments(builder, type_texts):
+    """ The per-attachment part of the old build_multi_part_message (dumps, substitute, loads, dumps again) """
+    attachments = []
+    for t, text in type_texts:
+        attachment_json = Template(json.dumps(builder.SUMMARIZED_MESSAGE['attachments'][0])) \
+            .safe_substitute(type=OpenProjectURL.part_to_text(t), type_counter=3, type_emoji=builder._TYPE_MAP[t][0],
+                             color=builder._TYPE_MAP[t][1], text=builder._highlight_text(text),
+                             activities_filtered_url=builder._op_url_builder.build_activity_url((t,)),
+                             authors="Jane (50%), John (50%).")
+        attachments.append(json.loads(attachment_json))
+    message = builder.SUMMARIZED_MESSAGE.copy()
+    message['attachments'] = attachments
+    return Template(json.dumps(message)).safe_substitute(changes=6, pre_praise="Cool.", minutes=3.0,
+                                                         base_url=builder._op_url_builder.base_url)
+
+
+def make_entries(count):
+    types = ('work_packages', 'wiki', 'news', 'documents', 'meetings', 'time_entries')
+    now = datetime.now(timezone.utc)
+    return [Activity(title="Task #{0}: Improve the dolphin's swimming speed".format(i),
+                     url="https://op.example.com/{0}/{1}".format(types[i % len(types)], i),
+                     author=("Jane", "John")[i % 2],
+                     type=types[i % len(types)],
+                     datetime=now) for i in range(count)]
+
+
+def rate(func, number):
+    return number / min(timeit.repeat(func, number=number, repeat=ROUNDS))
+
+
+def main():
+    for highlight_keywords in (False, True):
+        print("Keyword highlighting {0}:".format("on" if highlight_keywords else "off"))
+        run(SlackMessageBuilder(OpenProjectURL("https://op.example.com", 1), highlight_keywords=highlight_keywords))
+
+
+def run(builder):
+    entries = make_entries(12)
+    entry = entries[0]
+    type_texts = [(e.type, "<{0}|➜> {1}\\n".format(e.url, e.title)) for e in entries[:6]]
+
+    before = rate(lambda: legacy_single_message(builder, entry), 5000)
+    after = rate(lambda: builder.build_single_message(entry), 5000)
+    print("  Single message:     {0:>10.0f} msg/s before, {1:>10.0f} msg/s after ({2:.1f}x)"
+          .format(before, after, after / before))
+
+    before = rate(lambda: legacy_attachments(builder, type_texts), 1000)
+    after = rate(lambda: builder.build_multi_part_message(entries), 1000)
+    # Note: "after" includes the complete build_multi_part_message, "before" only the templating part of it.
+    print("  Summarized message: {0:>10.0f} msg/s before, {1:>10.0f} msg/s after ({2:.1f}x)"
+          .format(before, after, after / before))
+
+
+if __name__ == '__main__':
+    main()
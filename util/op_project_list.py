@@ -1,17 +1,16 @@
 """ OP-Projects-List
 
-! External dependency "requests" needed
-
-Tiny utility that lists projects in OpenProject by using a trial and error method (brute force).
-Why? The API of OP doesn't seem to provide a method to list existing projects, so this is a workaround.
+Tiny utility that lists the projects of an OpenProject instance (see op_dolphin_bot.discovery.ProjectDiscovery).
 In this project, it is used to easily find the project ID for the Dolphin Bot.
 
-It also shows how to use basic auth to access the OpenProject API.
+Usage (from the repository root): python -m util.op_project_list --help
 """
 
-import time
-import requests
-import json
+import argparse
+import logging
+
+from op_dolphin_bot.discovery import ProjectDiscovery
+from op_dolphin_bot.transport import HTTPTransport
 
 # START CONFIGURATION
 OP_BASE_URL = "YOUR OPENPROJECT URL"
@@ -19,13 +18,27 @@ OP_API_KEY = "YOUR API KEY"
 # END CONFIGURATION
 
 
-def show_projects(op_url, api_key, from_id=0, to_id=10, sleep=0.001):
-    for i in range(from_id, to_id + 1):
-        req = requests.get(op_url + "/api/v3/projects/" + str(i), auth=("apikey", api_key))
-        if req.status_code == 200:
-            req_dict = json.loads(str(req.content, 'utf8'))
-            print('{0} ({1})'.format(req_dict['name'], req_dict['identifier']), '-> ID:', req_dict['id'])
-        time.sleep(sleep)
+def show_projects(op_url, api_key, cache_path=None, max_misses=20, concurrency=8):
+    transport = HTTPTransport(pool_size=concurrency)
+    discovery = ProjectDiscovery.create(op_url, api_key, transport, concurrency, cache_path=cache_path,
+                                        max_misses=max_misses)
+    for project in discovery.projects(refresh=cache_path is None):
+        print('{0} ({1})'.format(project['name'], project['identifier']), '-> ID:', project['id'])
+    transport.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lists the projects of an OpenProject instance")
+    parser.add_argument('--url', default=OP_BASE_URL, help="Base URL of OpenProject")
+    parser.add_argument('--api-key', default=OP_API_KEY, help="API key (My account -> Access tokens)")
+    parser.add_argument('--cache', help="JSON file to cache the projects in (default: no cache)")
+    parser.add_argument('--max-misses', type=int, default=20,
+                        help="ID scan (older OpenProject versions): stop after N consecutive missing IDs")
+    parser.add_argument('--concurrency', type=int, default=8, help="Maximum number of requests in flight")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(levelname)s: %(message)s', level=logging.INFO)
+    show_projects(args.url, args.api_key, args.cache, args.max_misses, args.concurrency)
 
-show_projects(OP_BASE_URL, OP_API_KEY, 0, 50)
 
+if __name__ == '__main__':
+    main()
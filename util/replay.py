@@ -0,0 +1,54 @@
+""" Replay
+
+Feeds a recording of the Dolphin Bot (see RECORD_FILE in dolphin_bot.py and op_dolphin_bot.replay) through the bot
+again, without any network, and compares the posted messages with the recorded ones. Useful to reproduce formatting
+bugs and, at maximum speed with --profile, to profile the whole pipeline on captured production load.
+
+Usage (from the repository root): python -m util.replay --help
+"""
+
+import argparse
+import logging
+import sys
+import time
+
+from op_dolphin_bot.metrics import SamplingProfiler
+from op_dolphin_bot.replay import load_recording, replay, recorded_posts, diff_posts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays a recording of the Dolphin Bot and diffs the Slack output")
+    parser.add_argument('recording', help="Recorded file (gzip, see RECORD_FILE)")
+    parser.add_argument('--speed', type=float,
+                        help="Replays in real time multiplied by SPEED (default: at maximum speed)")
+    parser.add_argument('--smart-summary-limit', type=int, default=2, help="smart_summary_limit of the recorded bot")
+    parser.add_argument('--max-links', type=int, default=7, help="max_links of the recorded bot")
+    parser.add_argument('--refresh-rate', type=int, default=90, help="refresh_rate of the recorded bot")
+    parser.add_argument('--profile', action='store_true', help="Prints the hottest functions of the replay")
+    parser.add_argument('--verbose', action='store_true', help="Logs what the bot does")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(levelname)s: %(message)s',
+                        level=logging.INFO if args.verbose else logging.WARNING)
+
+    records = load_recording(args.recording)
+    profiler = SamplingProfiler()
+    if args.profile:
+        profiler.start()
+    started = time.perf_counter()
+    posts = replay(records, args.speed, smart_summary_limit=args.smart_summary_limit, max_links=args.max_links,
+                   refresh_rate=args.refresh_rate)
+    duration = time.perf_counter() - started
+    if args.profile:
+        print(profiler.stop())
+
+    expected = recorded_posts(records)
+    print("Replayed {0} records in {1:.2f} seconds: {2} messages posted, {3} recorded."
+          .format(len(records), duration, len(posts), len(expected)))
+    diff = diff_posts(expected, posts)
+    for line in diff:
+        print(line)
+    sys.exit(1 if diff else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,357 @@
+""" Stand-Ins
+
+Local HTTP stand-ins for OpenProject and Slack, used by the benchmarks so that they run without network access.
+
+- OpenProjectStandIn serves synthetic activity.atom feeds (/projects/{id}/activity.atom) that grow at a configurable
+  churn rate. It supports ETag/If-None-Match and gzip like a real server. The work packages of the feed are
+  available through the API v3, too (/api/v3/projects/{id}/work_packages and /api/v3/work_packages/{id}/activities),
+  as well as the projects (/api/v3/projects and /api/v3/projects/{id}).
+- SlackStandIn acts as Slack incoming webhook (any path) and records the payloads. It can inject latency,
+  5xx errors and 429 rate limiting (with Retry-After).
+- WebhookSender plays OpenProject's outgoing webhooks: it posts signed work package payloads to a
+  webhook.OpenProjectWebhookReceiver.
+"""
+
+import gzip
+import hashlib
+import hmac
+import json
+import random
+import re
+import threading
+import time
+import urllib.request
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler
+
+from op_dolphin_bot.metrics import ThreadingHTTPServer
+
+ATOM_TYPES = ('work_packages', 'wiki', 'news', 'meetings', 'documents')
+# Titles carry the project and sequence number of the entry, so notifications can be traced back to the entry:
+TITLE_FORMAT = "Task #{project}-{seq}: New dolphin feature in progress"
+TITLE_REFERENCE = re.compile(r'#(\d+)-(\d+)')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, Nagle's algorithm would delay the body until the client's ACK:
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.stand_in.handle(self, 'GET', None)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.server.stand_in.handle(self, 'POST', self.rfile.read(length))
+
+    def respond(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StandInServer:
+    """ Runs a threaded HTTP server on a free local port in the background """
+
+    def __init__(self):
+        self._server = None
+        self.url = None
+
+    def start(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.stand_in = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{0}".format(self._server.server_address[1])
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def handle(self, handler, method, body):
+        raise NotImplementedError
+
+
+class OpenProjectStandIn(StandInServer):
+    """ Serves synthetic Atom feeds for any project ID """
+
+    _FEED_PATH = re.compile(r'^/projects/(\d+)/activity\.atom')
+    _WORK_PACKAGES_PATH = re.compile(r'^/api/v3/projects/(\d+)/work_packages$')
+    _ACTIVITIES_PATH = re.compile(r'^/api/v3/work_packages/(\d+)/activities$')
+    _PROJECT_PATH = re.compile(r'^/api/v3/projects/(\d+)$')
+
+    def __init__(self, feed_size=50, churn=0.5, use_gzip=True, project_ids=range(1, 11), project_collection=True,
+                 time_resolution=None):
+        """
+        :param feed_size: Number of (newest) entries contained in each feed
+        :param churn: New entries per second and project
+        :param use_gzip: Compresses the feed if the client accepts gzip
+        :param project_ids: Projects listed by the API (the feeds are served for any project ID)
+        :param project_collection: Serves /api/v3/projects, older OpenProject versions only have the single projects
+        :param time_resolution: Truncates the published times to multiples of it (e.g. 1 second like OpenProject's
+                                Atom feed), so that bursts share timestamps. Default: microseconds.
+        """
+        super().__init__()
+        self.feed_size = feed_size
+        self.churn = churn
+        self.use_gzip = use_gzip
+        self.project_ids = sorted(project_ids)
+        self.project_collection = project_collection
+        self.time_resolution = time_resolution
+        self._start = time.time()
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'not_modified': 0, 'bytes_sent': 0, 'api_requests': 0}
+        # Entry count of the last feed response per project, i.e. the entries a reader can know about:
+        self.served_counts = {}
+
+    def entry_count(self, project, now=None):
+        """ Number of entries the project has at the given time """
+        now = time.time() if now is None else now
+        return self.feed_size + int((now - self._start) * self.churn)
+
+    def entry_time(self, project, seq):
+        """ (Wall clock) time at which the entry appeared in the feed """
+        return self._start + (seq - self.feed_size + 1) / self.churn if self.churn else self._start
+
+    def published_time(self, project, seq):
+        """ Time of the entry as published by the feed and the API (see time_resolution) """
+        timestamp = self.entry_time(project, seq)
+        if self.time_resolution:
+            return timestamp - timestamp % self.time_resolution
+        return timestamp
+
+    def handle(self, handler, method, body):
+        if method == 'GET' and handler.path.startswith('/api/v3/'):
+            self.handle_api(handler)
+            return
+        match = self._FEED_PATH.match(handler.path)
+        if method != 'GET' or match is None:
+            handler.respond(404)
+            return
+        project = int(match.group(1))
+        count = self.entry_count(project)
+        etag = '"{0}-{1}"'.format(project, count)
+        with self._lock:
+            self.stats['requests'] += 1
+            self.served_counts[project] = count
+        if handler.headers.get('If-None-Match') == etag:
+            with self._lock:
+                self.stats['not_modified'] += 1
+            handler.respond(304, headers={'ETag': etag})
+            return
+        feed = self.build_feed(project, count)
+        headers = {'Content-Type': "application/atom+xml; charset=utf-8", 'ETag': etag}
+        if self.use_gzip and 'gzip' in (handler.headers.get('Accept-Encoding') or ''):
+            feed = gzip.compress(feed, compresslevel=1)
+            headers['Content-Encoding'] = 'gzip'
+        with self._lock:
+            self.stats['bytes_sent'] += len(feed)
+        handler.respond(200, feed, headers)
+
+    def build_feed(self, project, count):
+        newest = count - 1
+        parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom" xml:lang="en">',
+                 '<title>Stand-In: Activity</title><id>{0}/projects/{1}/activity</id>'.format(self.url, project),
+                 '<updated>{0}</updated>'.format(_format_time(self.published_time(project, newest))),
+                 '<author><name>OpenProject</name></author>']
+        for seq in range(newest, max(-1, newest - self.feed_size), -1):
+            activity_type = ATOM_TYPES[seq % len(ATOM_TYPES)]
+            url = "{0}/{1}/{2}".format(self.url, activity_type, project * 1000000 + seq)
+            if activity_type == 'work_packages':
+                url += '#activity-1'
+            parts.append('<entry><title>{title}</title><link href="{url}" rel="alternate" type="text/html"/>'
+                         '<id>{url}</id><updated>{updated}</updated><author><name>{author}</name></author>'
+                         '<content type="html">Some details about the change.</content></entry>'
+                         .format(title=TITLE_FORMAT.format(project=project, seq=seq), url=url,
+                                 updated=_format_time(self.published_time(project, seq)),
+                                 author=_author(seq)))
+        parts.append('</feed>')
+        return ''.join(parts).encode('utf8')
+
+    def handle_api(self, handler):
+        """ API v3: every work package entry of the feed is a work package with a single activity (its creation) """
+        with self._lock:
+            self.stats['api_requests'] += 1
+        url = urlsplit(handler.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        match = self._WORK_PACKAGES_PATH.match(url.path)
+        if match is not None:
+            project = int(match.group(1))
+            since = 0.0
+            for query_filter in json.loads(query.get('filters', '[]')):
+                if 'updatedAt' in query_filter:
+                    since = _parse_time(query_filter['updatedAt']['values'][0])
+            count = self.entry_count(project)
+            seqs = [seq for seq in range(count - 1, -1, -1)
+                    if ATOM_TYPES[seq % len(ATOM_TYPES)] == 'work_packages' and self.published_time(project, seq) >= since]
+            page_size, offset = int(query.get('pageSize', 20)), int(query.get('offset', 1))
+            page = seqs[(offset - 1) * page_size:offset * page_size]
+            self._respond_json(handler, {
+                '_type': 'WorkPackageCollection', 'total': len(seqs), 'count': len(page), 'pageSize': page_size,
+                'offset': offset,
+                '_embedded': {'elements': [work_package_resource(project, seq, _author(seq),
+                                                                 self.published_time(project, seq)) for seq in page]},
+            })
+            return
+        if url.path == '/api/v3/projects' and self.project_collection:
+            page_size, offset = int(query.get('pageSize', 20)), int(query.get('offset', 1))
+            page = self.project_ids[(offset - 1) * page_size:offset * page_size]
+            self._respond_json(handler, {
+                '_type': 'Collection', 'total': len(self.project_ids), 'count': len(page), 'pageSize': page_size,
+                'offset': offset, '_embedded': {'elements': [_project_resource(p) for p in page]},
+            })
+            return
+        match = self._PROJECT_PATH.match(url.path)
+        if match is not None:
+            if int(match.group(1)) in self.project_ids:
+                self._respond_json(handler, _project_resource(int(match.group(1))))
+            else:
+                handler.respond(404)
+            return
+        match = self._ACTIVITIES_PATH.match(url.path)
+        if match is not None:
+            project, seq = divmod(int(match.group(1)), 1000000)
+            if seq >= self.entry_count(project):
+                handler.respond(404)
+                return
+            self._respond_json(handler, {'_type': 'Collection', 'total': 1, 'count': 1, '_embedded': {'elements': [{
+                '_type': 'Activity', 'id': int(match.group(1)), 'version': 1,
+                'createdAt': _format_time(self.published_time(project, seq)),
+                '_links': {
+                    'self': {'href': '/api/v3/activities/{0}'.format(match.group(1))},
+                    'workPackage': {'href': '/api/v3/work_packages/{0}'.format(match.group(1))},
+                    'user': {'href': '/api/v3/users/{0}'.format(seq % 3), 'title': _author(seq)},
+                },
+            }]}})
+            return
+        handler.respond(404)
+
+    @staticmethod
+    def _respond_json(handler, payload):
+        handler.respond(200, json.dumps(payload).encode('utf8'), {'Content-Type': 'application/hal+json'})
+
+
+class SlackStandIn(StandInServer):
+    """ Records posted payloads as (receive time, path, payload) in `payloads` """
+
+    def __init__(self, latency=0.0, error_rate=0.0, rate_limit_rate=0.0, retry_after=1, seed=None):
+        """
+        :param latency: Seconds to wait before answering
+        :param error_rate: Probability of answering with HTTP 500
+        :param rate_limit_rate: Probability of answering with HTTP 429 (and Retry-After)
+        :param retry_after: Value of the Retry-After header in seconds
+        """
+        super().__init__()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.payloads = []
+        self.stats = {'requests': 0, 'errors': 0, 'rate_limited': 0}
+
+    def handle(self, handler, method, body):
+        if method != 'POST':
+            handler.respond(405)
+            return
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.stats['requests'] += 1
+            dice = self._random.random()
+            if dice < self.rate_limit_rate:
+                self.stats['rate_limited'] += 1
+                status = 429
+            elif dice < self.rate_limit_rate + self.error_rate:
+                self.stats['errors'] += 1
+                status = 500
+            else:
+                status = 200
+                self.payloads.append((time.time(), handler.path, json.loads(body.decode('utf8'))))
+        if status == 429:
+            handler.respond(429, b'rate_limited', {'Retry-After': str(self.retry_after)})
+        elif status == 500:
+            handler.respond(500, b'internal_error')
+        else:
+            handler.respond(200, b'ok')
+
+
+class WebhookSender:
+    """ Sends work package events like OpenProject's outgoing webhooks (signed with X-OP-Signature) """
+
+    def __init__(self, webhook_url, secret=None):
+        self.webhook_url = webhook_url
+        self.secret = secret
+        self.sent = []
+
+    def send_work_package(self, project, seq, action='work_package:updated', author="Flipper", updated=None):
+        """ Sends an event for work package #project-seq and returns the HTTP status of the receiver """
+        resource = work_package_resource(project, seq, author, time.time() if updated is None else updated)
+        return self.send({'action': action, 'work_package': resource})
+
+    def send(self, payload, signature=None, sign=True):
+        """ Sends the payload and returns the HTTP status of the receiver. `signature` replaces the one computed with
+        the secret (e.g. to send an invalid one), sign=False sends none at all. """
+        body = json.dumps(payload).encode('utf8')
+        headers = {'Content-Type': 'application/json'}
+        if not sign:
+            signature = None
+        elif signature is None and self.secret is not None:
+            signature = 'sha1=' + hmac.new(self.secret.encode('utf8'), body, hashlib.sha1).hexdigest()
+        if signature is not None:
+            headers['X-OP-Signature'] = signature
+        request = urllib.request.Request(self.webhook_url, data=body, headers=headers, method='POST')
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                status = response.status
+        except urllib.request.HTTPError as err:
+            status = err.code
+        self.sent.append((time.time(), payload, status))
+        return status
+
+
+def work_package_resource(project, seq, author, updated):
+    """ Work package #project-seq in the shape of the API v3 representation (reduced to what is used) """
+    wp_id = project * 1000000 + seq
+    return {
+        '_type': 'WorkPackage',
+        'id': wp_id,
+        'subject': TITLE_FORMAT.format(project=project, seq=seq),
+        'createdAt': _format_time(updated),
+        'updatedAt': _format_time(updated),
+        '_embedded': {
+            'project': {'_type': 'Project', 'id': project, 'identifier': 'project-{0}'.format(project)},
+        },
+        '_links': {
+            'self': {'href': '/api/v3/work_packages/{0}'.format(wp_id)},
+            'type': {'href': '/api/v3/types/1', 'title': 'Task'},
+            'status': {'href': '/api/v3/statuses/7', 'title': 'In progress'},
+            'author': {'href': '/api/v3/users/1', 'title': author},
+            'project': {'href': '/api/v3/projects/{0}'.format(project), 'title': 'Project {0}'.format(project)},
+        },
+    }
+
+
+def _project_resource(project):
+    return {'_type': 'Project', 'id': project, 'identifier': 'project-{0}'.format(project),
+            'name': 'Project {0}'.format(project)}
+
+
+def _author(seq):
+    return ("Jane Doe", "John Doe", "Flipper")[seq % 3]
+
+
+def _format_time(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def _parse_time(text):
+    return datetime.strptime(text, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc).timestamp()